@@ -0,0 +1,178 @@
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+
+class FrameCache(object):
+	""" Memory-mapped file of decoded frames for repeated dataset passes
+
+		File layout: 8 byte magic, 4 byte little endian header length,
+		JSON header, zero padding up to a page boundary and finally every
+		frame stored back to back as a raw C-contiguous array
+
+		self._start: Dataset index of the first cached frame
+		self._end: Dataset index one past the last cached frame
+		self._key: Hash of the source frames and camera file
+		self._frames: Memory-mapped (numFrames, *frameShape) array
+
+	"""
+	magic = b'CVTKFRM1'
+	alignment = 4096
+
+	@classmethod
+	def create(cls, filename, loader, start, end, key, grayscale=False, reduction=1, undistorted=False):
+		""" Decodes frames [start, end) through loader and writes them to filename
+
+		"""
+		first = np.ascontiguousarray(loader(start))
+
+		header = {'version':1, 'key':key, 'start':start, 'end':end,
+					'shape':list(first.shape), 'dtype':first.dtype.str,
+					'grayscale':grayscale, 'reduction':reduction, 'undistorted':undistorted}
+
+		headerBytes = json.dumps(header).encode('utf-8')
+		prefix = cls.magic + struct.pack('<I', len(headerBytes)) + headerBytes
+		offset = cls._alignedOffset(len(prefix))
+
+		# Write to a temporary file first so readers never map a partial cache
+		tmpFilename = f"{filename}.{os.getpid()}.tmp"
+
+		try:
+			with open(tmpFilename, mode='wb') as f:
+				f.write(prefix)
+				f.write(b'\0' * (offset - len(prefix)))
+
+			shape = (end - start,) + first.shape
+			frames = np.memmap(tmpFilename, dtype=first.dtype, mode='r+', offset=offset, shape=shape)
+
+			frames[0] = first
+			for index in range(start + 1, end):
+				frames[index - start] = loader(index)
+
+			frames.flush()
+			del frames
+
+			os.replace(tmpFilename, filename)
+		finally:
+			if (os.path.exists(tmpFilename)):
+				os.remove(tmpFilename)
+
+		return cls.open(filename, key)
+
+	@classmethod
+	def open(cls, filename, key=None):
+		""" Maps an existing cache file, returns None if missing or stale
+
+		"""
+		if (not os.path.exists(filename)):
+			return None
+
+		header, offset = cls._readHeader(filename)
+
+		if (header is None):
+			print("Warning: Frame cache file is corrupt, ignoring", filename)
+			return None
+
+		if (key is not None and header['key'] != key):
+			return None
+
+		shape = (header['end'] - header['start'],) + tuple(header['shape'])
+
+		# Frames are read-only views, callers must copy a frame before drawing on it
+		frames = np.memmap(filename, dtype=np.dtype(header['dtype']), mode='r',
+			offset=offset, shape=shape)
+
+		return cls(filename, frames, header)
+
+	@classmethod
+	def _readHeader(cls, filename):
+		with open(filename, mode='rb') as f:
+			prefix = f.read(len(cls.magic) + 4)
+
+			if (len(prefix) < len(cls.magic) + 4 or prefix[:len(cls.magic)] != cls.magic):
+				return (None, 0)
+
+			headerLength, = struct.unpack('<I', prefix[len(cls.magic):])
+			header = json.loads(f.read(headerLength).decode('utf-8'))
+
+		return (header, cls._alignedOffset(len(prefix) + headerLength))
+
+	@classmethod
+	def _alignedOffset(cls, length):
+		return -(-length // cls.alignment) * cls.alignment
+
+	def __init__(self, filename, frames, header):
+		self._filename = filename
+		self._frames = frames
+		self._start = header['start']
+		self._end = header['end']
+		self._key = header['key']
+		self._grayscale = header['grayscale']
+		self._reduction = header.get('reduction', 1)
+		self._undistorted = header['undistorted']
+
+	def __reduce__(self):
+		# Remap the file rather than pickling frame data
+		return (FrameCache.open, (self._filename, self._key))
+
+	def __contains__(self, index):
+		return self._start <= index < self._end
+
+	def __getitem__(self, index):
+		# Zero-copy read-only view into the mapped file
+		return self._frames[index - self._start]
+
+	def __len__(self):
+		return self._end - self._start
+
+	@property
+	def filename(self):
+		return self._filename
+
+	@property
+	def start(self):
+		return self._start
+
+	@property
+	def end(self):
+		return self._end
+
+	@property
+	def key(self):
+		return self._key
+
+	@property
+	def grayscale(self):
+		return self._grayscale
+
+	@property
+	def reduction(self):
+		return self._reduction
+
+	@property
+	def undistorted(self):
+		return self._undistorted
+
+	@property
+	def frameShape(self):
+		return self._frames.shape[1:]
+
+
+def sourceKey(frames, cameraFile=None):
+	""" Hash identifying a frame list and camera file
+
+		Frame files contribute their name, size and modification time, the
+		camera file contributes its full contents
+	"""
+	h = hashlib.sha1()
+
+	for frame in frames:
+		stat = os.stat(frame)
+		h.update(f"{os.path.basename(frame)}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+
+	if (cameraFile is not None and os.path.exists(cameraFile)):
+		with open(cameraFile, mode='rb') as f:
+			h.update(f.read())
+
+	return h.hexdigest()
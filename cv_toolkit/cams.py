@@ -1,13 +1,20 @@
+import os
 import yaml
+import hashlib
 import cv2
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+
 class FisheyeCamera(yaml.YAMLObject):
 	""" Object representing a fisheye camera model
 
 		self._K: Camera intrinsics
 		self._D: Camera distortion coefficients
 		self._imgSize: Camera image size in pixels
+		self._balance: Balance passed to estimateNewCameraMatrixForUndistortRectify
+		self._fovScale: FOV scale passed to estimateNewCameraMatrixForUndistortRectify
+		self._filename: Camera file, undistortion maps are cached next to it
 
 	"""
 	yaml_tag = '!Fisheye_Camera'
@@ -16,10 +23,11 @@ class FisheyeCamera(yaml.YAMLObject):
 	def from_file(cls, filename):
 		with open(filename, mode='r') as f:
 			cam = yaml.load(f)
+			cam._filename = filename
 			cam._initialize()
 			return cam
 
-	def __init__(self, K, D, imgSize, name=None, fmt=None):
+	def __init__(self, K, D, imgSize, name=None, fmt=None, balance=1.0, fovScale=1.0, filename=None):
 		self._K = np.asarray(K)
 		self._D = np.asarray(D)
 
@@ -30,6 +38,10 @@ class FisheyeCamera(yaml.YAMLObject):
 		self._name = name
 		self._format = fmt
 
+		self._balance = balance
+		self._fovScale = fovScale
+		self._filename = filename
+
 		self._initialize()
 
 	def _initialize(self):
@@ -37,6 +49,11 @@ class FisheyeCamera(yaml.YAMLObject):
 		self._D = np.asarray(self._D)
 		self._imgSize = tuple(self._imgSize)
 
+		# Camera files written before these were configurable use the defaults
+		self._balance = getattr(self, '_balance', 1.0)
+		self._fovScale = getattr(self, '_fovScale', 1.0)
+		self._filename = getattr(self, '_filename', None)
+
 		imgWidth, imgHeight = self._imgSize
 
 	
@@ -62,61 +79,305 @@ class FisheyeCamera(yaml.YAMLObject):
 
 		"""
 
+		# Maps are loaded lazily from the on-disk cache when available
+		self._map1 = None
+		self._map2 = None
+
+		# Thread pool for tiled undistortion, created on first use
+		self._executor = None
+
+		# Optional interpolated point lookup tables, see enablePointLookup
+		self._undistortLookup = None
+		self._distortLookup = None
+
+		if (self._mapsCached()):
+			self._newK = np.load(self._mapFilename('newK'))
+			self._initializeCrop()
+			return
+
 		# Initialize new K matrix, balance=1.0 to show entire
 		self._newK = cv2.fisheye.estimateNewCameraMatrixForUndistortRectify(self._K,
-			self._D, (imgWidth, imgHeight), R=np.eye(3), balance=1.0, fov_scale=1.0)
-
-		
+			self._D, (imgWidth, imgHeight), R=np.eye(3), balance=self._balance,
+			fov_scale=self._fovScale)
 
 		self._map1, self._map2 = cv2.fisheye.initUndistortRectifyMap(self._K, 
 			self._D, np.eye(3), self._newK, (imgWidth, imgHeight), cv2.CV_16SC2)
 
+		self._saveMaps()
+		self._initializeCrop()
+
+	def _initializeCrop(self, samples=16):
+		""" Computes largest rectangle of the undistorted image covered by the source image
+
+			Samples points along each border of the source image and takes the
+			innermost undistorted position on each side
+		"""
+		imgWidth, imgHeight = self._imgSize
+		xs = np.linspace(0, imgWidth - 1, samples)
+		ys = np.linspace(0, imgHeight - 1, samples)
+
+		left = self.undistortPoints(np.column_stack((np.zeros(samples), ys)))
+		right = self.undistortPoints(np.column_stack((np.full(samples, imgWidth - 1), ys)))
+		top = self.undistortPoints(np.column_stack((xs, np.zeros(samples))))
+		bottom = self.undistortPoints(np.column_stack((xs, np.full(samples, imgHeight - 1))))
+
+		self._left = int(np.clip(np.ceil(left[:, 0].max()), 0, imgWidth))
+		self._right = int(np.clip(np.floor(right[:, 0].min()), self._left, imgWidth))
+		self._top = int(np.clip(np.ceil(top[:, 1].max()), 0, imgHeight))
+		self._bottom = int(np.clip(np.floor(bottom[:, 1].min()), self._top, imgHeight))
+
+	def _mapKey(self):
+		h = hashlib.sha1()
+		h.update(np.ascontiguousarray(self._K, dtype=np.float64).tobytes())
+		h.update(np.ascontiguousarray(self._D, dtype=np.float64).tobytes())
+		h.update(repr((self._imgSize, float(self._balance), float(self._fovScale))).encode('utf-8'))
+
+		return h.hexdigest()[:16]
+
+	def _mapFilename(self, name):
+		return f"{self._filename}.{self._mapKey()}.{name}.npy"
+
+	def _mapsCached(self):
+		if (self._filename is None):
+			return False
+
+		return all(os.path.exists(self._mapFilename(n)) for n in ('newK', 'map1', 'map2'))
+
+	def _saveMaps(self):
+		if (self._filename is None):
+			return
+
+		try:
+			for name, arr in (('map1', self._map1), ('map2', self._map2), ('newK', self._newK)):
+				saveArray(self._mapFilename(name), arr)
+		except OSError as e:
+			print("Warning: Cannot cache undistortion maps", e)
+
+	def _loadMaps(self):
+		# Memory map cached maps so processes sharing a camera share the pages
+		if (self._map1 is None):
+			self._map1 = np.load(self._mapFilename('map1'), mmap_mode='r')
+			self._map2 = np.load(self._mapFilename('map2'), mmap_mode='r')
+
+		return (self._map1, self._map2)
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+
+		state['_executor'] = None
+
+		# Maps cached on disk are remapped on demand instead of being pickled
+		if (self._mapsCached()):
+			state['_map1'] = None
+			state['_map2'] = None
+
+		return state
+
+	def scaled(self, imgSize):
+		""" Returns a copy of the camera for images resized to imgSize
+
+			Fisheye distortion acts on normalized coordinates so only the
+			intrinsics are rescaled, D is unchanged
+		"""
+		scaleX = imgSize[0] / self._imgSize[0]
+		scaleY = imgSize[1] / self._imgSize[1]
 
+		K = np.diag([scaleX, scaleY, 1.0]).dot(self._K)
+
+		return FisheyeCamera(K, self._D, imgSize, self._name, self._format,
+			self._balance, self._fovScale, self._filename)
 
 	def save(self, filename):
 		with open(filename, mode='w') as f:
 			yaml.dump(self, f)
 
-	def undistortImage(self, img, cropped=False):
-		undistorted = cv2.remap(img, self._map1, self._map2,
-			interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+	def undistortImage(self, img, cropped=False, tiles=1):
+		""" Undistorts img, remapping horizontal bands on a thread pool if tiles > 1
+
+			If cropped only the region covered by the source image is computed
+		"""
+		if (cropped):
+			rect = (self._left, self._top, self._right - self._left, self._bottom - self._top)
+			return self.undistortRegion(img, rect, tiles)
+
+		imgWidth, imgHeight = self._imgSize
+		return self.undistortRegion(img, (0, 0, imgWidth, imgHeight), tiles)
+
+	def undistortRegion(self, img, rect, tiles=1):
+		""" Undistorts only the output rectangle rect = (x, y, width, height)
+
+			Rect is given in undistorted image coordinates (e.g. from selectROI)
+			and the precomputed maps are sliced so only those pixels are remapped
+		"""
+		map1, map2 = self._loadMaps()
+
+		x, y, w, h = [int(v) for v in rect]
+		map1 = map1[y:(y+h), x:(x+w)]
+		map2 = map2[y:(y+h), x:(x+w)]
+
+		if (tiles <= 1 or h < 2 * tiles):
+			return self._remap(img, map1, map2)
+
+		undistorted = np.empty((map1.shape[0], map1.shape[1]) + img.shape[2:], dtype=img.dtype)
+		bands = np.linspace(0, map1.shape[0], tiles + 1).astype(int)
+
+		if (self._executor is None):
+			self._executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+		# Each band writes into its own rows of the output, remap releases the GIL
+		futures = [self._executor.submit(self._remap, img, map1[top:bottom], map2[top:bottom],
+			undistorted[top:bottom]) for top, bottom in zip(bands[:-1], bands[1:])]
+
+		for future in futures:
+			future.result()
+
+		return undistorted
+
+	def _remap(self, img, map1, map2, dst=None):
+		map1 = np.ascontiguousarray(map1)
+		map2 = np.ascontiguousarray(map2)
+
+		if (dst is None):
+			return cv2.remap(img, map1, map2, interpolation=cv2.INTER_LINEAR,
+				borderMode=cv2.BORDER_CONSTANT)
+
+		cv2.remap(img, map1, map2, dst=dst, interpolation=cv2.INTER_LINEAR,
+			borderMode=cv2.BORDER_CONSTANT)
+
+		return dst
+
+	def enablePointLookup(self, step=4, tolerance=0.1, samples=1000):
+		""" Map points through bilinearly interpolated lookup tables
+
+			Tables hold the exact solver output on a grid with the given pixel
+			step, over the source image for undistortPoints and over the
+			undistorted image for distortPoints. The step is halved until the
+			max error on sample points is below tolerance pixels. Tables are
+			cached next to the camera file. Returns the achieved max error
+		"""
+		self.disablePointLookup()
+
+		# Fixed seed so the chosen step, and the cached tables, are repeatable
+		rng = np.random.RandomState(0)
+
+		# Interpolation error peaks where distortion is strongest, so check
+		# points along the border and in the corners as well as the interior
+		imgWidth, imgHeight = self._imgSize
+		border = np.linspace(0, 1, samples // 4)[:, np.newaxis]
+		samplePoints = np.vstack((rng.rand(samples, 2) * self._imgSize,
+			np.hstack((border * imgWidth, np.full_like(border, 0.5))),
+			np.hstack((border * imgWidth, np.full_like(border, imgHeight - 0.5))),
+			np.hstack((np.full_like(border, 0.5), border * imgHeight)),
+			np.hstack((np.full_like(border, imgWidth - 0.5), border * imgHeight)),
+			rng.rand(samples // 4, 2) * 32,
+			rng.rand(samples // 4, 2) * -32 + self._imgSize,
+			rng.rand(samples // 4, 2) * [32, -32] + [0, imgHeight],
+			rng.rand(samples // 4, 2) * [-32, 32] + [imgWidth, 0]))
+		exactUndistorted = self.undistortPoints(samplePoints)
+		exactDistorted = self.distortPoints(samplePoints)
+
+		while (True):
+			self._undistortLookup = self._loadLookup('undistort', step, self._undistortPointsExact)
+			self._distortLookup = self._loadLookup('distort', step, self._distortPointsExact)
+
+			error = max(np.abs(self.undistortPoints(samplePoints) - exactUndistorted).max(),
+						np.abs(self.distortPoints(samplePoints) - exactDistorted).max())
+
+			if (error <= tolerance or step <= 1):
+				break
+
+			self.disablePointLookup()
+			step = max(1, step // 2)
 
-		if (not cropped):
-			return undistorted
+		if (error > tolerance):
+			print("Warning: Point lookup error above tolerance", error)
 
-		croppedImg = undistorted[self._top:self._bottom, self._left:self._right]
-		return croppedImg
+		# Only the tables of the chosen step are cached
+		self._saveLookup('undistort', self._undistortLookup)
+		self._saveLookup('distort', self._distortLookup)
+
+		return error
+
+	def disablePointLookup(self):
+		self._undistortLookup = None
+		self._distortLookup = None
+
+	def _loadLookup(self, name, step, exact):
+		filename = None if self._filename is None else self._mapFilename(f"{name}{step}")
+
+		if (filename is not None and os.path.exists(filename)):
+			return PointLookupTable(np.load(filename, mmap_mode='r'), step)
+
+		# Sample one step past the image edge so border points interpolate
+		imgWidth, imgHeight = self._imgSize
+		xs = np.arange(0, imgWidth + step, step, dtype=np.float64)
+		ys = np.arange(0, imgHeight + step, step, dtype=np.float64)
+		grid = np.stack(np.meshgrid(xs, ys), axis=-1)
+
+		return PointLookupTable(exact(grid), step)
+
+	def _saveLookup(self, name, lookup):
+		if (self._filename is None):
+			return
+
+		filename = self._mapFilename(f"{name}{lookup.step}")
+		if (os.path.exists(filename)):
+			return
+
+		try:
+			saveArray(filename, lookup.table)
+		except OSError as e:
+			print("Warning: Cannot cache point lookup table", e)
 
 	def undistortPoints(self, points):
-		points = np.asarray(points)
-		assert points.ndim == 2 and points.shape[1] == 2
+		""" Undistorts an (N,2) array, or any (..., 2) stack of points, in one call
+
+		"""
+		if (self._undistortLookup is not None):
+			return self._undistortLookup.apply(points, self._undistortPointsExact)
+
+		return self._undistortPointsExact(points)
+
+	def _undistortPointsExact(self, points):
+		points = np.asarray(points, dtype=np.float32)
+		assert points.shape[-1] == 2
+
+		shape = points.shape if points.ndim > 1 else (-1, 2)
 
-		if points.ndim == 2:
-			points = np.expand_dims(points, 0)
+		if (points.size == 0):
+			return points.reshape(shape)
 
-		undistorted = cv2.fisheye.undistortPoints(points.astype(np.float32), self._K, 
+		undistorted = cv2.fisheye.undistortPoints(points.reshape(-1, 1, 2), self._K, 
 			self._D, R=np.eye(3), P=self._newK)
 
-		return np.squeeze(undistorted).reshape(-1,2)
+		return undistorted.reshape(shape)
 
 	def distortPoints(self, points):
-		pInv = np.linalg.inv(self._newK)
+		""" Maps undistorted (N,2) or (..., 2) points back into the source image
+
+		"""
+		if (self._distortLookup is not None):
+			return self._distortLookup.apply(points, self._distortPointsExact)
+
+		return self._distortPointsExact(points)
 
-		newPoints = []
-		for p in points:
-			newP = np.matmul(pInv,np.lib.pad(p, (0,1), 'constant', constant_values=1).reshape(3,1))
-			newPoints.append(np.squeeze(newP[0:2].reshape(1,2)))
+	def _distortPointsExact(self, points):
+		points = np.asarray(points, dtype=np.float64)
+		assert points.shape[-1] == 2
 
-		points = np.asarray(newPoints)
+		shape = points.shape if points.ndim > 1 else (-1, 2)
 
-		assert points.ndim == 2 and points.shape[1] == 2
+		if (points.size == 0):
+			return points.astype(np.float32).reshape(shape)
 
-		if points.ndim == 2:
-			points = np.expand_dims(points, 0)
+		# Normalize all points with the inverse of the new camera matrix at once
+		pInv = np.linalg.inv(self._newK)
+		normalized = points.reshape(-1, 2).dot(pInv[:2, :2].T) + pInv[:2, 2]
 
-		distorted = cv2.fisheye.distortPoints(points.astype(np.float32), self._K, self._D)
+		distorted = cv2.fisheye.distortPoints(normalized.reshape(-1, 1, 2).astype(np.float32),
+			self._K, self._D)
 
-		return np.squeeze(distorted).reshape(-1,2)
+		return distorted.reshape(shape)
 
 	@classmethod
 	def to_yaml(cls, dumper, data):
@@ -132,12 +393,118 @@ class FisheyeCamera(yaml.YAMLObject):
 		newKNode = data._newK.tolist()
 
 		dict_rep = {'_K':kNode, '_D':dNode, '_imgSize':sizeNode, 
-					'_name':data._name, '_format':data._format}
+					'_name':data._name, '_format':data._format,
+					'_balance':data._balance, '_fovScale':data._fovScale}
 
 		node = dumper.represent_mapping(cls.yaml_tag, dict_rep)
 		return node
 
+	@property
+	def cropBounds(self):
+		# (left, top, right, bottom) in undistorted image coordinates
+		return (self._left, self._top, self._right, self._bottom)
+
+	@property
+	def map1(self):
+		return self._loadMaps()[0]
+
+	@property
+	def map2(self):
+		return self._loadMaps()[1]
+
 	@property
 	def imgSize(self):
 		# (width, height)
-		return self._imgSize
\ No newline at end of file
+		return self._imgSize
+
+class PointLookupTable(object):
+	""" Dense grid of point mappings sampled every step pixels
+
+		self._table: (rows, cols, 2) float32 mapped position of each grid node
+		self._step: Pixel spacing between grid nodes
+
+	"""
+
+	def __init__(self, table, step):
+		self._table = np.ascontiguousarray(table, dtype=np.float32)
+		self._step = step
+
+	def apply(self, points, exact):
+		""" Bilinearly interpolates points, exact() handles points off the grid
+
+			cv2.remap resolves positions to 1/32 of the grid step, the
+			tolerance check in enablePointLookup includes this error
+		"""
+		points = np.asarray(points, dtype=np.float32)
+		assert points.shape[-1] == 2
+
+		shape = points.shape if points.ndim > 1 else (-1, 2)
+		flat = points.reshape(-1, 2)
+
+		rows, cols = self._table.shape[:2]
+		grid = flat * np.float32(1.0 / self._step)
+
+		inside = (grid[:,0] >= 0) & (grid[:,1] >= 0) & (grid[:,0] <= cols - 1) & (grid[:,1] <= rows - 1)
+
+		mapped = remapPoints(self._table, grid)
+
+		if (not inside.all()):
+			mapped[~inside] = exact(flat[~inside]).reshape(-1, 2)
+
+		return mapped.reshape(shape)
+
+	@property
+	def table(self):
+		return self._table
+
+	@property
+	def step(self):
+		return self._step
+
+
+def saveArray(filename, arr):
+	""" np.save arr to filename through a temporary file
+
+		Concurrent workers loading filename never see a partial array
+	"""
+	tmpFilename = f"{filename}.{os.getpid()}.tmp"
+
+	try:
+		with open(tmpFilename, mode='wb') as f:
+			np.save(f, arr)
+		os.replace(tmpFilename, filename)
+	finally:
+		if (os.path.exists(tmpFilename)):
+			os.remove(tmpFilename)
+
+
+def remapPoints(src, points, tileWidth=1024):
+	""" Bilinearly samples src at (n, 2) float pixel positions, returns (n, channels)
+
+		Runs cv2.remap with the positions laid out in rows tileWidth long,
+		as remap maps must stay below SHRT_MAX rows. Positions off src take
+		the value of the nearest border pixel
+	"""
+	points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+	channels = src.shape[2] if src.ndim > 2 else 1
+
+	sampled = np.empty((len(points), channels), dtype=src.dtype)
+	if (len(points) < 1):
+		return sampled
+
+	tileWidth = min(tileWidth, len(points))
+	chunkSize = tileWidth * (np.iinfo(np.int16).max - 1)
+
+	for start in range(0, len(points), chunkSize):
+		chunk = points[start:start + chunkSize]
+		tileRows = -(-len(chunk) // tileWidth)
+
+		# Pad the last row, samples of the padding are dropped
+		tile = np.zeros((tileRows * tileWidth, 2), dtype=np.float32)
+		tile[:len(chunk)] = chunk
+
+		dst = cv2.remap(src, tile.reshape(tileRows, tileWidth, 2), None, cv2.INTER_LINEAR,
+			borderMode=cv2.BORDER_REPLICATE)
+		sampled[start:start + len(chunk)] = dst.reshape(-1, channels)[:len(chunk)]
+
+	return sampled
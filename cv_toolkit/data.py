@@ -6,6 +6,16 @@ import os
 import numpy as np
 
 from .cams import FisheyeCamera
+from .prefetch import FramePrefetcher
+from .cache import FrameCache, sourceKey
+from .parallel import mapDataset
+from .video import VideoReader, isVideoFile
+
+# imread flags for each (grayscale, reduction) decode mode
+decodeFlags = {(False, 1):cv2.IMREAD_COLOR, (True, 1):cv2.IMREAD_GRAYSCALE,
+				(False, 2):cv2.IMREAD_REDUCED_COLOR_2, (True, 2):cv2.IMREAD_REDUCED_GRAYSCALE_2,
+				(False, 4):cv2.IMREAD_REDUCED_COLOR_4, (True, 4):cv2.IMREAD_REDUCED_GRAYSCALE_4,
+				(False, 8):cv2.IMREAD_REDUCED_COLOR_8, (True, 8):cv2.IMREAD_REDUCED_GRAYSCALE_8}
 
 class Dataset(yaml.YAMLObject):
 	""" Object representing a dataset
@@ -66,12 +76,32 @@ class Dataset(yaml.YAMLObject):
 		# Init frame list to []
 		self._frames = []
 
+		# Video file reader, None when frames are image files
+		self._video = None
+
 		# Init frame index to dataset start frame
 		self._currFrameIndex = start
 
 		# Buffered current image
 		self._currFrame = None
 
+		# Background frame decoder, None when reading synchronously
+		self._prefetcher = None
+
+		# Memory-mapped decoded frames, None when decoding from source
+		self._cache = None
+
+		# Decode frames directly to grayscale and/or at 1/reduction size
+		self._grayscale = False
+		self._reduction = 1
+		self._decodeFlags = cv2.IMREAD_COLOR
+		self._useCache = False
+
+		# Full resolution mask, camera and image size before decode mode scaling
+		self._fullMask = None
+		self._fullCamera = None
+		self._fullImgSize = None
+
 	def save(self, filename=None):
 		if (filename is None):
 			filename = self._name + '.yaml'
@@ -86,12 +116,212 @@ class Dataset(yaml.YAMLObject):
 
 	def read(self):
 		del self._currFrame
-		self._currFrame = cv2.imread(self._frames[self._currFrameIndex])
+
+		if (self._prefetcher is not None):
+			_, self._currFrame = self._prefetcher.next()
+		else:
+			self._currFrame = self._loadFrame(self._currFrameIndex)
+
 		timestamp = self.currentTime
 		self._currFrameIndex += 1
 
 		return (self._currFrame, timestamp)
 
+	def seek(self, index):
+		""" Move read position to frame index without decoding skipped frames
+
+		"""
+		if (index < self._startFrame or index > self._endFrame):
+			print("Error: Seek index is beyond dataset bounds")
+			return
+
+		self._currFrameIndex = index
+
+		if (self._prefetcher is not None):
+			self._prefetcher.reset(range(self._currFrameIndex, self._endFrame))
+
+	def frames(self, step=1, start=None, end=None):
+		""" Generator of (frame, timestamp) for every step-th frame in [start, end)
+
+			Only the requested frames are decoded, defaults to the remaining
+			frames of the dataset. Does not move the read position used by
+			read(), and decodes in the background if prefetching is enabled
+		"""
+		if (start is None):
+			start = self._currFrameIndex
+
+		if (end is None):
+			end = self._endFrame
+
+		indices = range(max(start, self._startFrame), min(end, self._endFrame), step)
+
+		if (self._prefetcher is None):
+			for index in indices:
+				yield (self._loadFrame(index), self.frameTime(index))
+
+			return
+
+		prefetcher = FramePrefetcher(self._loadFrame, indices,
+			self._prefetcher.depth, self._prefetcher.workers)
+
+		try:
+			index, frame = prefetcher.next()
+			while (index is not None):
+				yield (frame, self.frameTime(index))
+				index, frame = prefetcher.next()
+		finally:
+			prefetcher.close()
+
+	def __iter__(self):
+		while (self.more()):
+			yield self.read()
+
+	def map(self, stage, workers=None, chunkSize=None):
+		""" Run stage(frame, timestamp) on remaining frames in a process pool
+
+			Returns a generator of (result, timestamp) in frame order, does
+			not advance the current frame index
+		"""
+		return mapDataset(self, stage, workers, chunkSize)
+
+	def prefetch(self, depth=4, workers=2):
+		""" Decode the next depth frames on a pool of background threads
+
+			read() and more() behave as before, but frames are handed out
+			from the prefetch buffer so decode overlaps with processing
+		"""
+		self.stopPrefetch()
+
+		# A video is decoded in order on a single capture
+		if (self._video is not None):
+			workers = 1
+
+		indices = range(self._currFrameIndex, self._endFrame)
+		self._prefetcher = FramePrefetcher(self._loadFrame, indices, depth, workers)
+
+		return self._prefetcher
+
+	def stopPrefetch(self):
+		if (self._prefetcher is not None):
+			self._prefetcher.close()
+			self._prefetcher = None
+
+	def setDecodeMode(self, grayscale=False, reduction=1):
+		""" Decode frames directly to grayscale and/or at 1/2, 1/4 or 1/8 size
+
+			imgSize, mask and camera are rescaled to match decoded frames
+		"""
+		if ((grayscale, reduction) not in decodeFlags):
+			print("Error: Unsupported decode reduction", reduction)
+			return
+
+		self._grayscale = grayscale
+		self._reduction = reduction
+
+		if (self._fullImgSize is not None):
+			self._applyDecodeMode()
+
+		# Frames already buffered were decoded in the previous mode
+		if (self._prefetcher is not None):
+			self.prefetch(self._prefetcher.depth, self._prefetcher.workers)
+
+	def _applyDecodeMode(self):
+		self._decodeFlags = decodeFlags[(self._grayscale, self._reduction)]
+
+		# Only serve cached frames decoded in the same mode, undistorted
+		# frames only to the dataset that asked for them in materialize()
+		self._useCache = (self._cache is not None and self._cache.grayscale == self._grayscale
+			and self._cache.reduction == self._reduction and not self._cache.undistorted)
+
+		if (self._useCache):
+			imgHeight, imgWidth = self._cache.frameShape[:2]
+		elif (self._reduction == 1):
+			imgWidth, imgHeight = self._fullImgSize
+		else:
+			imgHeight, imgWidth = self._loadFrame(self._currFrameIndex).shape[:2]
+
+		self._imgSize = (imgWidth, imgHeight)
+
+		if (self._imgSize == self._fullImgSize):
+			self._mask = self._fullMask
+			self._camera = self._fullCamera
+			return
+
+		if (self._fullMask is not None):
+			self._mask = cv2.resize(self._fullMask, self._imgSize, interpolation=cv2.INTER_NEAREST)
+
+		if (self._fullCamera is not None):
+			self._camera = self._fullCamera.scaled(self._imgSize)
+
+	def materialize(self, filename=None, undistort=False):
+		""" Decode frames between start and end frame once into a frame cache
+
+			Frames are stored in the current decode mode. Subsequent passes
+			(and datasets loaded from the same folder) serve frames as
+			zero-copy views into the memory-mapped cache file, frames outside
+			the cached range are decoded from source. Cached frames
+			are read-only, copy a frame before drawing on it. A cache of
+			undistorted frames is only served by this dataset, load() decodes
+			from source rather than hand out frames to be undistorted twice
+		"""
+		if (filename is None):
+			filename = self.cacheFilename
+
+		if (undistort and self._camera is None):
+			print("Error: Cannot undistort frame cache without camera calibration")
+			return None
+
+		end = min(self._endFrame, self.numFrames)
+
+		def loader(index):
+			img = self._decodeFrame(index)
+
+			if (undistort):
+				img = self._camera.undistortImage(img)
+
+			return img
+
+		self._cache = FrameCache.create(filename, loader, self._startFrame, end,
+			self._sourceKey(), self._grayscale, self._reduction, undistort)
+		self._useCache = True
+
+		return self._cache
+
+	def _sourceKey(self):
+		# Covers every frame in the folder, datasets over other ranges of the
+		# same recording share the cache and serve the frames it holds
+		cameraFile = None
+
+		if (self._cameraFile is not None):
+			cameraFile = f"{self._path}{self._cameraFile}"
+
+		if (self._video is not None):
+			return sourceKey([self._video.filename], cameraFile)
+
+		return sourceKey(self._frames, cameraFile)
+
+	def _loadFrame(self, index):
+		if (self._useCache and index in self._cache):
+			return self._cache[index]
+
+		return self._decodeFrame(index)
+
+	def _decodeFrame(self, index):
+		if (self._video is None):
+			return cv2.imread(self._frames[index], self._decodeFlags)
+
+		# Video frames are only available in full color, convert after decode
+		img = self._video.read(index)
+
+		if (img is not None and self._grayscale):
+			img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+		if (img is not None and self._reduction > 1):
+			scale = 1.0 / self._reduction
+			img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+		return img
+
 	def load(self):
 		""" Load bulky components of dataset
 
@@ -103,11 +333,14 @@ class Dataset(yaml.YAMLObject):
 			print("Error: Dataset location does not exist")
 			return
 
-		# Check if mask file present in image folder
-		if (os.path.exists(f"{self._path}{self._imgFolder}/mask.npy")):
-			self._mask = np.load(f"{self._path}{self._imgFolder}/mask.npy")
+		# Check if mask file present in image folder (or next to video file)
+		if (os.path.exists(self._sidecarFilename('mask.npy'))):
+			self._mask = np.load(self._sidecarFilename('mask.npy'))
 
-		self._frames = sorted(glob.glob(f"{self._path}{self._imgFolder}/frame*.{self._extension}"))
+		if (isVideoFile(self._imgFolder)):
+			self._video = VideoReader(self._path + self._imgFolder)
+		else:
+			self._frames = sorted(glob.glob(f"{self._path}{self._imgFolder}/frame*.{self._extension}"))
 
 		# Check if camera file is available
 		if (self._cameraFile is not None and os.path.exists(f"{self._path}{self._cameraFile}")):
@@ -117,20 +350,41 @@ class Dataset(yaml.YAMLObject):
 			print("Error: Cannot load dataset camera calibration")
 
 		# Check if startFrame is beyond dataset bounds
-		if (self._startFrame > len(self._frames)):
+		if (self._startFrame > self.numFrames):
 			print("Error: Start frame is beyond dataset bounds")
 			return
 
 		# Check if endFrame is beyond dataset bounds
-		if (self._endFrame > len(self._frames)):
+		if (self._endFrame > self.numFrames):
 			print("Warning: End frame beyond dataset bounds, setting to end of dataset")
 
+		# Check if an up to date frame cache is present in image folder
+		if (os.path.exists(self.cacheFilename)):
+			self._cache = FrameCache.open(self.cacheFilename, self._sourceKey())
+
+			if (self._cache is None):
+				print("Warning: Frame cache out of date, removing", self.cacheFilename)
+				os.remove(self.cacheFilename)
+
+		# Initialize full resolution image size from first image
+		if (self._video is not None):
+			self._fullImgSize = self._video.frameSize
+		else:
+			imgHeight, imgWidth = cv2.imread(self._frames[self._currFrameIndex]).shape[:2]
+			self._fullImgSize = (imgWidth, imgHeight)
+
+		self._fullMask = self._mask
+		self._fullCamera = self._camera
+
+		# Initialize imageSize, mask and camera for decode mode
+		self._applyDecodeMode()
+
 		# Load first image
-		self._currFrame = cv2.imread(self._frames[self._currFrameIndex])
+		self._currFrame = self._loadFrame(self._currFrameIndex)
 
-		# Initialize imageSize
-		imgHeight, imgWidth = self._currFrame.shape[:2]
-		self._imgSize = (imgWidth, imgHeight)
+		# Overlap video decode with processing
+		if (self._video is not None):
+			self.prefetch(workers=1)
 
 
 	def construct(self, location, cam, start=0, end=None):
@@ -159,6 +413,14 @@ class Dataset(yaml.YAMLObject):
 
 		self._imgSize = cam.imgSize
 
+	def __getstate__(self):
+		# Decode threads and buffered frames stay with the original dataset
+		state = self.__dict__.copy()
+		state['_prefetcher'] = None
+		state['_currFrame'] = None
+
+		return state
+
 	@classmethod
 	def to_yaml(cls, dumper, data):
 		""" Serializes dataset parameters to yaml for output to file
@@ -193,6 +455,14 @@ class Dataset(yaml.YAMLObject):
 	def currentFrameIndex(self):
 		return self._currFrameIndex
 
+	@property
+	def startFrame(self):
+		return self._startFrame
+
+	@property
+	def endFrame(self):
+		return self._endFrame
+
 	@property
 	def filename(self):
 		return self._filename
@@ -208,7 +478,44 @@ class Dataset(yaml.YAMLObject):
 
 	@property
 	def currentTime(self):
-		return self._currFrameIndex * self._timestep
+		return self.frameTime(self._currFrameIndex)
+
+	def frameTime(self, index):
+		return index * self._timestep
+
+	def _sidecarFilename(self, name):
+		# Files belonging to a video live next to it, prefixed by its name
+		if (isVideoFile(self._imgFolder)):
+			return f"{self._path}{self._imgFolder}.{name}"
+
+		return f"{self._path}{self._imgFolder}/{name}"
+
+	@property
+	def numFrames(self):
+		if (self._video is not None):
+			return len(self._video)
+
+		return len(self._frames)
+
+	@property
+	def cacheFilename(self):
+		return self._sidecarFilename('frames.cache')
+
+	@property
+	def cache(self):
+		return self._cache
+
+	@property
+	def prefetcher(self):
+		return self._prefetcher
+
+	@property
+	def grayscale(self):
+		return self._grayscale
+
+	@property
+	def reduction(self):
+		return self._reduction
 
 	@property
 	def mask(self):
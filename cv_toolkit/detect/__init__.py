@@ -1,3 +1,3 @@
-__all__ = ['features', 'adapters', 'asv']
+__all__ = ['features', 'adapters', 'asv', 'keypoints']
 
 from . import features
\ No newline at end of file
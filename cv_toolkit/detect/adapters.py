@@ -1,9 +1,11 @@
 import cv2
+import threading
 import numpy as np
 
-from .base import Detector
+from concurrent.futures import ThreadPoolExecutor
 
-from primitives.keypoint import KeyPoint
+from .base import Detector
+from .keypoints import KeyPointBatch
 
 
 class GridDetector(Detector):
@@ -14,7 +16,7 @@ class GridDetector(Detector):
 		detector = ShiTomasiDetector()
 		return cls(detector, gridDim, featureLimit, borderBuffer)"""
 
-	def __init__(self, detector, gridDim, featureLimit, borderBuffer=0):
+	def __init__(self, detector, gridDim, featureLimit, borderBuffer=0, workers=1):
 		self._detector = detector
 
 		self._gridDimensions = gridDim
@@ -27,41 +29,225 @@ class GridDetector(Detector):
 
 		self._detector.featureLimit = self._featuresPerCell
 
+		# Cells are dispatched to a thread pool when workers > 1, each worker
+		# thread detects with its own clone of the detector
+		self._workers = workers
+		self._executor = None
+		self._local = threading.local()
+
+		# Open pixel count per cell, reused while the same mask object is passed
+		self._occupancyMask = None
+		self._occupancyKey = None
+		self._occupancyCells = None
+		self._occupancy = None
+
 		print(self._featureLimit, self._featuresPerCell)
 
 	@classmethod
-	def from_grid(cls, detector, grid, featureLimit, borderBuffer=0):
-		return cls(detector, grid.dim, featureLimit, borderBuffer)
+	def from_grid(cls, detector, grid, featureLimit, borderBuffer=0, workers=1):
+		return cls(detector, grid.dim, featureLimit, borderBuffer, workers)
 
 	def detect(self, img, mask):
-		heightStep = int((img.shape[0] - 2 * self._buffer) / self._gridDimensions[1])
-		widthStep = int((img.shape[1] - 2 * self._buffer) / self._gridDimensions[0])
-
 		# Declare features array
 		features = []
-		detect_method = self._detector.detect
+
+		cells, budgets = self._cellBudgets(img.shape, mask)
+		for newFeatures in self._mapCells(self._detectCell, img, mask, cells, budgets):
+			if newFeatures is not None:
+				features.extend(list(newFeatures))
+
+		print("Grid Detector loops:", len(cells))
+		return np.asarray(features)
+
+	def redetect(self, img, mask, points, targetDensity=0.5, radius=5):
+		""" Tops up the features of depleted cells only
+
+			Cells holding fewer than targetDensity times their budget are
+			refilled up to the budget, away from the surviving points by at
+			least radius. Returns the surviving points followed by the new ones.
+		"""
+		points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+
+		cells, budgets = self._cellBudgets(img.shape, mask)
+		if (len(cells) < 1):
+			return points
+
+		# Histogram of surviving points over the grid cells
+		heightStep, widthStep, rows, cols = self._cellLayout(img.shape)
+		col = np.floor((points[:,0] - self._buffer) / widthStep).astype(int)
+		row = np.floor((points[:,1] - self._buffer) / heightStep).astype(int)
+		valid = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+		counts = np.bincount(row[valid] * cols + col[valid], minlength=rows*cols)
+
+		layout = np.asarray(cells).reshape(-1, 4)
+		cellIndex = ((layout[:,0] - self._buffer) // heightStep) * cols + (layout[:,1] - self._buffer) // widthStep
+		budgets = np.asarray(budgets)
+		deficit = np.maximum(budgets - counts[cellIndex], 0)
+
+		# With targetDensity above 1 a depleted cell may already be at its budget
+		depleted = np.flatnonzero((counts[cellIndex] < targetDensity * budgets) & (deficit > 0))
+
+		if (len(depleted) < 1):
+			return points
+
+		searchMask = excludePoints(img.shape, points, radius, mask)
+
+		features = []
+		cells = [cells[c] for c in depleted]
+		for newFeatures in self._mapCells(self._detectCell, img, searchMask, cells, deficit[depleted].tolist()):
+			if newFeatures is not None:
+				features.extend(list(newFeatures))
+
+		print("Grid Detector loops:", len(cells))
+		if (len(features) < 1):
+			return points
+
+		return np.vstack((points, np.asarray(features, dtype=np.float32).reshape(-1, 2)))
+
+	def _detectCell(self, detector, img, mask, cell):
+		i, j, heightStep, widthStep = cell
+
+		searchMask = None if mask is None else mask[i:(i+heightStep), j:(j+widthStep)]
+		subImg = img[i:(i+heightStep), j:(j+widthStep)]
+
+		newFeatures = detector.detect(subImg, searchMask)
+
+		# Offset feature locations according to grid cell
+		if newFeatures is not None:
+			newFeatures = newFeatures.reshape(-1, 2)
+			newFeatures += np.array([[j,i]])
+
+		return newFeatures
+
+	def _cellSize(self, shape):
+		heightStep = int((shape[0] - 2 * self._buffer) / self._gridDimensions[1])
+		widthStep = int((shape[1] - 2 * self._buffer) / self._gridDimensions[0])
+
+		return (heightStep, widthStep)
+
+	def _cells(self, shape):
+		""" Returns (top, left, height, width) of each grid cell in row major order
+
+		"""
+		heightStep, widthStep = self._cellSize(shape)
 		buff = self._buffer
-		loopcount = 0
-		for i in np.arange(buff, img.shape[0]-heightStep-buff+1, heightStep):
-			for j in np.arange(buff, img.shape[1]-widthStep-buff+1, widthStep):
-				#print(i, i+heightStep, j, j+widthStep)
-				searchMask = mask[i:(i+heightStep), j:(j+widthStep)]
-				subImg = img[i:(i+heightStep), j:(j+widthStep)]
 
-				newFeatures = detect_method(subImg, searchMask)
+		return [(i, j, heightStep, widthStep)
+				for i in np.arange(buff, shape[0]-heightStep-buff+1, heightStep)
+				for j in np.arange(buff, shape[1]-widthStep-buff+1, widthStep)]
 
-				# Offset feature locations according to grid cell
-				if newFeatures is not None:
-					newFeatures = newFeatures.reshape(-1, 2)
-					newFeatures += np.array([[j,i]])
+	def _cellLayout(self, shape):
+		""" Returns (height, width, rows, cols) of the grid cells
 
-					features.extend(list(newFeatures))
+		"""
+		heightStep, widthStep = self._cellSize(shape)
+		rows = len(np.arange(self._buffer, shape[0]-heightStep-self._buffer+1, heightStep))
+		cols = len(np.arange(self._buffer, shape[1]-widthStep-self._buffer+1, widthStep))
 
-				loopcount += 1
+		return (heightStep, widthStep, rows, cols)
 
+	def _cellOccupancy(self, shape, mask):
+		""" Returns the grid cells and the number of unmasked pixels in each
 
-		print("Grid Detector loops:", loopcount)
-		return np.asarray(features)
+			Computed from an integral image of the mask and cached until a
+			different mask object (or image size or grid) is passed. Masks
+			edited in place must be passed as a new array to be picked up.
+		"""
+		key = (tuple(shape[:2]), tuple(self._gridDimensions), self._buffer)
+
+		if (mask is self._occupancyMask and key == self._occupancyKey):
+			return (self._occupancyCells, self._occupancy)
+
+		cells = self._cells(shape)
+		layout = np.asarray(cells, dtype=np.int64).reshape(-1, 4)
+		top, left = layout[:, 0], layout[:, 1]
+		bottom, right = top + layout[:, 2], left + layout[:, 3]
+
+		if (mask is None):
+			occupancy = layout[:, 2] * layout[:, 3]
+		else:
+			integral = cv2.integral((mask > 0).astype(np.uint8))
+			occupancy = (integral[bottom, right] - integral[top, right]
+						- integral[bottom, left] + integral[top, left])
+
+		self._occupancyMask = mask
+		self._occupancyKey = key
+		self._occupancyCells = cells
+		self._occupancy = occupancy
+
+		return (cells, occupancy)
+
+	def _cellBudgets(self, shape, mask):
+		""" Returns the cells worth detecting in and the feature limit of each
+
+			The featureLimit budget is shared out proportionally to each
+			cell's open area so budget of masked cells isn't lost. Without a
+			mask every cell gets featuresPerCell and the remainder goes one
+			feature each to the first cells. Cells left without budget are
+			skipped.
+		"""
+		cells, occupancy = self._cellOccupancy(shape, mask)
+
+		return self._allocate(cells, occupancy, self._featureLimit)
+
+	def _allocate(self, cells, weights, total):
+		""" Splits total features over cells proportionally to weights
+
+			Returns the cells with a non zero budget and their budgets
+		"""
+		weightSum = weights.sum()
+		if (weightSum <= 0 or total < 1):
+			return ([], [])
+
+		share = total * weights / weightSum
+		budgets = np.floor(share).astype(int)
+
+		# Hand out what flooring left over to the largest remainders
+		leftover = int(round(share.sum())) - budgets.sum()
+		if (leftover > 0):
+			budgets[np.argsort(budgets - share, kind='stable')[:leftover]] += 1
+
+		active = np.flatnonzero(budgets > 0)
+
+		return ([cells[c] for c in active], budgets[active].tolist())
+
+	def _mapCells(self, func, img, mask, cells, budgets):
+		""" Applies func(detector, img, mask, cell) to every cell, results in cell order
+
+			The detector's featureLimit is set to the cell's budget first.
+		"""
+		def run(detector, cell, budget):
+			if (detector.featureLimit != budget):
+				detector.featureLimit = budget
+
+			return func(detector, img, mask, cell)
+
+		if (self._workers <= 1):
+			return [run(self._detector, cell, budget) for cell, budget in zip(cells, budgets)]
+
+		if (self._executor is None):
+			self._executor = ThreadPoolExecutor(max_workers=self._workers)
+
+		# OpenCV releases the GIL while detecting, map keeps results in cell order
+		return list(self._executor.map(lambda cell, budget: run(self._workerDetector(), cell, budget), cells, budgets))
+
+	def _workerDetector(self):
+		# cv2 detector objects are not safe to share, clone one per thread
+		detector = getattr(self._local, 'detector', None)
+
+		if (detector is None):
+			detector = self._detector.clone()
+			self._local.detector = detector
+
+		return detector
+
+	def setWorkers(self, workers):
+		if (self._executor is not None):
+			self._executor.shutdown(wait=True)
+			self._executor = None
+
+		self._local = threading.local()
+		self._workers = workers
 
 	def setGrid(self, gridDim):
 		self._gridDimensions = gridDim
@@ -70,6 +256,10 @@ class GridDetector(Detector):
 		self._featuresPerCell = int(self._featureLimit / self._numCells)
 		self._detector.featureLimit = self._featuresPerCell
 
+	@property
+	def workers(self):
+		return self._workers
+
 	@property
 	def featureLimit(self):
 		return self._featureLimit
@@ -98,74 +288,47 @@ class KeyPointGridDetector(GridDetector):
 		self._detector.featureLimit = self._featuresPerCell
 		"""
 
-	def detect(self, img, mask):
-		heightStep = int((img.shape[0] - 2 * self._buffer) / self._gridDimensions[0])
-		widthStep = int((img.shape[1] - 2 * self._buffer) / self._gridDimensions[1])
-
-		# Declare features array
-		features = []
-		detect_method = self._detector.detect
-		buff = self._buffer
-		loopcount = 0
-		for i in np.arange(buff, img.shape[0]-heightStep-buff+1, heightStep):
-			for j in np.arange(buff, img.shape[1]-widthStep-buff+1, widthStep):
-				#print(i, i+heightStep, j, j+widthStep)
-				searchMask = mask[i:(i+heightStep), j:(j+widthStep)]
-				subImg = img[i:(i+heightStep), j:(j+widthStep)]
-
-				newFeatures = detect_method(subImg, searchMask)
-
-				# Offset feature locations according to grid cell
-				if newFeatures is not None:
-					newFeatures = newFeatures.reshape(-1, 2)
-					newFeatures += np.array([[j,i]])
-
-					features.extend(list(newFeatures))
+	def _cellSize(self, shape):
+		heightStep = int((shape[0] - 2 * self._buffer) / self._gridDimensions[0])
+		widthStep = int((shape[1] - 2 * self._buffer) / self._gridDimensions[1])
 
-				loopcount += 1
+		return (heightStep, widthStep)
 
+	def detectKeyPoints(self, img, mask):
+		""" Returns (KeyPointBatch, descriptors) of the keypoints in all cells
 
-		print("Grid Detector loops:", loopcount)
-		return np.asarray(features)
-
+		"""
+		cells, budgets = self._cellBudgets(img.shape, mask)
+		results = self._mapCells(self._detectCellKeyPoints, img, mask, cells, budgets)
 
-	def detectKeyPoints(self, img, mask):
-		heightStep = int((img.shape[0] - 2 * self._buffer) / self._gridDimensions[0])
-		widthStep = int((img.shape[1] - 2 * self._buffer) / self._gridDimensions[1])
+		# Cell offsets are applied with one add over the joined batch
+		offsets = [(j, i) for i, j, _, _ in cells]
+		keyPoints = KeyPointBatch.concatenate([kp for kp, _ in results], offsets)
 
-		# Declare features array
-		keyPoints = []
-		descriptors = []
-		angles = []
-		detect_method = self._detector.detectKeyPoints
-		buff = self._buffer
-		loopcount = 0
-		for i in np.arange(buff, img.shape[0]-heightStep-buff+1, heightStep):
-			for j in np.arange(buff, img.shape[1]-widthStep-buff+1, widthStep):
-				#print(i, i+heightStep, j, j+widthStep)
-				searchMask = mask[i:(i+heightStep), j:(j+widthStep)]
-				subImg = img[i:(i+heightStep), j:(j+widthStep)]
+		descriptors = [des for _, des in results if len(des) > 0]
+		descriptors = np.concatenate(descriptors) if len(descriptors) > 0 else np.asarray([])
 
-				newKP, newDescriptors = detect_method(subImg, searchMask)
+		print("Grid Detector loops:", len(cells))
+		return (keyPoints, descriptors)
 
-				if newKP is not None and len(newKP) > 0:
-					newKeyPoints = []
-					offset = np.asarray([[j,i]])
-					for kp in newKP:
-						KP = KeyPoint.from_cv_keypoint(kp)
-						KP.offset(offset)
-						newKeyPoints.append(KP)
+	def _detectCellKeyPoints(self, detector, img, mask, cell):
+		i, j, heightStep, widthStep = cell
 
-					keyPoints.extend(newKeyPoints)
-					descriptors.extend(newDescriptors)
+		searchMask = None if mask is None else mask[i:(i+heightStep), j:(j+widthStep)]
+		subImg = img[i:(i+heightStep), j:(j+widthStep)]
 
-				loopcount += 1
+		newKP, newDescriptors = detector.detectKeyPoints(subImg, searchMask)
 
+		if newKP is None or len(newKP) < 1:
+			return (KeyPointBatch(), [])
 
-		print("Grid Detector loops:", loopcount)
-		return (keyPoints, np.asarray(descriptors))
+		# Cell relative, offset once all cells are joined
+		return (KeyPointBatch.from_cv_keypoints(newKP), newDescriptors)
 
 	def compute(self, img, keyPoints):
+		if (isinstance(keyPoints, KeyPointBatch)):
+			keyPoints = keyPoints.toCVKeyPoints()
+
 		return self._detector.compute(img, keyPoints)
 
 	def setGrid(self, gridDim):
@@ -187,4 +350,108 @@ class KeyPointGridDetector(GridDetector):
 		self._detector.featureLimit = self._featuresPerCell
 
 
-# Todo: Priority grid detector which allocates features to cells according to some heatmap
\ No newline at end of file
+class PriorityGridDetector(GridDetector):
+	""" Grid detector sharing its feature budget out according to a cell heatmap
+
+		Heat is added from points, such as where tracks were recently lost,
+		and from per pixel maps like flow magnitude or texture. It decays on
+		every update so detection time goes to the cells that currently need
+		new features. Here featureLimit is the total over all cells.
+
+		self._heat: Heat of each grid cell, (rows, cols)
+		self._decay: Fraction of the heat kept from one update to the next
+		self._baseline: Heat added to every cell when budgeting, keeps some exploration
+	"""
+
+	def __init__(self, detector, gridDim, featureLimit, borderBuffer=0, workers=1, decay=0.8, baseline=0.):
+		super().__init__(detector, gridDim, featureLimit, borderBuffer, workers)
+
+		self._decay = decay
+		self._baseline = baseline
+
+		# Sized on first use, uniform until heat is added
+		self._heat = None
+
+	def update(self, shape, points=None, heatmap=None, weight=1.):
+		""" Decays the heatmap and adds the latest observations
+
+			points: (n, 2) image points, each adds weight to its cell
+			heatmap: Per pixel map of the image size or per cell (rows, cols) map
+		"""
+		heightStep, widthStep, rows, cols = self._cellLayout(shape)
+		heat = self._cellHeat(shape)
+		heat *= self._decay
+
+		if (points is not None and len(points) > 0):
+			points = np.asarray(points).reshape(-1, 2)
+			col = np.floor((points[:,0] - self._buffer) / widthStep).astype(int)
+			row = np.floor((points[:,1] - self._buffer) / heightStep).astype(int)
+			valid = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+
+			counts = np.bincount(row[valid] * cols + col[valid], minlength=rows*cols)
+			heat += weight * counts.reshape(rows, cols)
+
+		if (heatmap is not None):
+			heatmap = np.asarray(heatmap, dtype=np.float32)
+
+			if (heatmap.shape != (rows, cols)):
+				# Average the per pixel map over each cell
+				buff = self._buffer
+				region = heatmap[buff:(buff + rows * heightStep), buff:(buff + cols * widthStep)]
+				heatmap = region.reshape(rows, heightStep, cols, widthStep).mean(axis=(1,3))
+
+			heat += weight * heatmap
+
+	def resetHeat(self):
+		self._heat = None
+
+	def _cellHeat(self, shape):
+		rows, cols = self._cellLayout(shape)[2:]
+
+		if (self._heat is None or self._heat.shape != (rows, cols)):
+			self._heat = np.ones((rows, cols))
+
+		return self._heat
+
+	def _cellBudgets(self, shape, mask):
+		cells, occupancy = self._cellOccupancy(shape, mask)
+		weights = occupancy * (self._cellHeat(shape).ravel() + self._baseline)
+
+		return self._allocate(cells, weights, self._featureLimit)
+
+	def setGrid(self, gridDim):
+		super().setGrid(gridDim)
+		self._heat = None
+
+	@property
+	def heat(self):
+		return self._heat
+
+	@property
+	def decay(self):
+		return self._decay
+
+	@decay.setter
+	def decay(self, decay):
+		self._decay = decay
+
+
+def excludePoints(shape, points, radius, mask=None):
+	""" Returns a search mask with a disc of radius cleared around every point
+
+		Built by dilating an image of point impulses. mask, if given, is
+		combined with the exclusion and left unmodified.
+	"""
+	impulses = np.zeros(shape[:2], dtype=np.uint8)
+
+	p = np.round(np.asarray(points)).astype(int).reshape(-1, 2)
+	inside = (p[:,0] >= 0) & (p[:,0] < shape[1]) & (p[:,1] >= 0) & (p[:,1] < shape[0])
+	impulses[p[inside,1], p[inside,0]] = 255
+
+	kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*radius+1, 2*radius+1))
+	free = cv2.bitwise_not(cv2.dilate(impulses, kernel))
+
+	if (mask is None):
+		return free
+
+	return cv2.bitwise_and(mask, free)
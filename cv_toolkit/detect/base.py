@@ -1,3 +1,5 @@
+import copy
+
 from abc import ABCMeta, abstractmethod
 
 class Detector(metaclass=ABCMeta):
@@ -7,6 +9,10 @@ class Detector(metaclass=ABCMeta):
 		# Must return detections in some standard format
 		pass
 
+	def clone(self):
+		# Independent copy for use from another thread
+		return copy.deepcopy(self)
+
 	@property
 	@abstractmethod
 	def featureLimit(self):
@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 
 from .base import Detector
+from .keypoints import KeyPointBatch, fromCVKeyPoints
 
 class ShiTomasiDetector(Detector):
 
@@ -25,6 +26,9 @@ class ShiTomasiDetector(Detector):
 
 		return self._detector(img, mask=mask, **self._params)
 
+	def clone(self):
+		return ShiTomasiDetector(**self._params)
+
 	@property
 	def featureLimit(self):
 		return self._featureLimit
@@ -63,16 +67,45 @@ class ORBDetector(Detector):
 		return (points, descriptors)
 
 	def compute(self, img, keyPoints):
+		if (isinstance(keyPoints, KeyPointBatch)):
+			keyPoints = keyPoints.toCVKeyPoints()
+
 		keyPoints, descriptors = self._detector.compute(img, keyPoints)
 
 		return descriptors
 
+	def detectAndComputeBatch(self, imgs, masks=None):
+		""" Detects and describes keypoints in a list of images or tiles
+
+			Runs a single detect and compute over the whole list. Returns a
+			list of (keyPoints, descriptors) per image with keyPoints as a
+			keyPointDtype array.
+		"""
+		imgs = list(imgs)
+
+		if (masks is None):
+			keyPoints = self._detector.detect(imgs)
+		else:
+			keyPoints = self._detector.detect(imgs, list(masks))
+
+		keyPoints, descriptors = self._detector.compute(imgs, keyPoints)
+
+		emptyDescriptors = np.empty((0, self._detector.descriptorSize()), dtype=np.uint8)
+
+		return [(fromCVKeyPoints(kp), emptyDescriptors if des is None else des)
+				for kp, des in zip(keyPoints, descriptors)]
+
+	def clone(self):
+		# Fresh cv2.ORB instance, these can't be shared between threads
+		return ORBDetector(dict(self._params))
+
 	@property
 	def featureLimit(self):
 		return self._featureLimit
 
 	@featureLimit.setter
 	def featureLimit(self, limit):
+		# Reconfigure in place, params are kept for clones
 		self._params['nfeatures'] = limit
 		self._featureLimit = limit
-		self._detector = cv2.ORB_create(**self._params)
+		self._detector.setMaxFeatures(limit)
@@ -0,0 +1,146 @@
+import cv2
+import numpy as np
+
+# Compact keypoint record, the cv2.KeyPoint fields used by the detectors
+# with id stored in the cv2.KeyPoint class_id
+keyPointDtype = np.dtype([('x', np.float32), ('y', np.float32), ('size', np.float32),
+						('angle', np.float32), ('response', np.float32), ('octave', np.int32),
+						('id', np.int64)])
+
+
+def fromCVKeyPoints(keyPoints):
+	""" Converts a sequence of cv2.KeyPoint to a keyPointDtype array
+
+	"""
+	return np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
+					for kp in keyPoints], dtype=keyPointDtype)
+
+
+def toCVKeyPoints(keyPoints):
+	""" Converts a keyPointDtype array to a list of cv2.KeyPoint
+
+	"""
+	return [cv2.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave), int(id))
+			for x, y, size, angle, response, octave, id in keyPoints.tolist()]
+
+
+class KeyPointBatch(object):
+	""" Batch of keypoints stored as one array per field
+
+		Replaces lists of cv2.KeyPoint or primitives KeyPoint objects inside
+		the detectors and trackers, cv2.KeyPoint objects are only built when
+		handing keypoints to OpenCV.
+
+		self._points: (n, 2) float32 keypoint locations
+		self._size, self._angle, self._response: (n,) float32
+		self._octave: (n,) int32
+		self._ids: (n,) int64 keypoint identities, -1 if unassigned
+	"""
+
+	def __init__(self, points=None, size=None, angle=None, response=None, octave=None, ids=None):
+		self._points = np.empty((0, 2), dtype=np.float32) if points is None else np.asarray(points, dtype=np.float32).reshape(-1, 2)
+		n = len(self._points)
+
+		self._size = np.zeros(n, dtype=np.float32) if size is None else np.asarray(size, dtype=np.float32)
+		self._angle = np.full(n, -1, dtype=np.float32) if angle is None else np.asarray(angle, dtype=np.float32)
+		self._response = np.zeros(n, dtype=np.float32) if response is None else np.asarray(response, dtype=np.float32)
+		self._octave = np.zeros(n, dtype=np.int32) if octave is None else np.asarray(octave, dtype=np.int32)
+		self._ids = np.full(n, -1, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+
+	@classmethod
+	def from_cv_keypoints(cls, keyPoints):
+		return cls.from_array(fromCVKeyPoints(keyPoints))
+
+	@classmethod
+	def from_array(cls, keyPoints):
+		""" Builds a batch from a keyPointDtype array
+
+		"""
+		points = np.stack((keyPoints['x'], keyPoints['y']), axis=-1)
+
+		return cls(points, keyPoints['size'], keyPoints['angle'], keyPoints['response'],
+					keyPoints['octave'], keyPoints['id'])
+
+	@classmethod
+	def concatenate(cls, batches, offsets=None):
+		""" Joins batches into one, optionally offsetting each batch's points
+
+			offsets: (len(batches), 2) offset added to the points of each batch
+		"""
+		batches = list(batches)
+		if (len(batches) < 1):
+			return cls()
+
+		joined = cls(np.concatenate([b._points for b in batches]),
+					np.concatenate([b._size for b in batches]),
+					np.concatenate([b._angle for b in batches]),
+					np.concatenate([b._response for b in batches]),
+					np.concatenate([b._octave for b in batches]),
+					np.concatenate([b._ids for b in batches]))
+
+		if (offsets is not None):
+			counts = [len(b) for b in batches]
+			joined.offset(np.repeat(np.asarray(offsets, dtype=np.float32).reshape(-1, 2), counts, axis=0))
+
+		return joined
+
+	def __len__(self):
+		return len(self._points)
+
+	def __getitem__(self, index):
+		# Index, slice, boolean mask or index array, slices are views as in numpy
+		if (np.isscalar(index)):
+			index = [index]
+
+		return KeyPointBatch(self._points[index], self._size[index], self._angle[index],
+							self._response[index], self._octave[index], self._ids[index])
+
+	def offset(self, offset):
+		""" Shifts all keypoints in place by offset, (2,) or (n, 2)
+
+		"""
+		self._points += np.asarray(offset, dtype=np.float32)
+
+		return self
+
+	def toArray(self):
+		keyPoints = np.empty(len(self), dtype=keyPointDtype)
+		keyPoints['x'], keyPoints['y'] = self._points[:,0], self._points[:,1]
+		keyPoints['size'] = self._size
+		keyPoints['angle'] = self._angle
+		keyPoints['response'] = self._response
+		keyPoints['octave'] = self._octave
+		keyPoints['id'] = self._ids
+
+		return keyPoints
+
+	def toCVKeyPoints(self):
+		return toCVKeyPoints(self.toArray())
+
+	@property
+	def points(self):
+		return self._points
+
+	@property
+	def size(self):
+		return self._size
+
+	@property
+	def angle(self):
+		return self._angle
+
+	@property
+	def response(self):
+		return self._response
+
+	@property
+	def octave(self):
+		return self._octave
+
+	@property
+	def ids(self):
+		return self._ids
+
+	@ids.setter
+	def ids(self, ids):
+		self._ids = np.asarray(ids, dtype=np.int64)
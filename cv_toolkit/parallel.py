@@ -0,0 +1,171 @@
+import os
+import weakref
+import collections
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
+# Dataset copy owned by each worker process, set by _initWorker
+_workerDataset = None
+
+class SharedArray(object):
+	""" Handle to an array returned from a worker through shared memory
+
+	"""
+
+	def __init__(self, name, shape, dtype):
+		self.name = name
+		self.shape = shape
+		self.dtype = dtype
+
+
+def mapDataset(dataset, stage, workers=None, chunkSize=None, shareThreshold=65536):
+	""" Runs stage(frame, timestamp) over [startFrame, endFrame) in worker processes
+
+		Frames are split into contiguous chunks which are read and processed
+		independently in each worker. Yields (result, timestamp) in frame
+		order. Arrays of at least shareThreshold bytes in the result are
+		passed back through shared memory instead of being pickled.
+
+		Workers are spawned rather than forked so they don't inherit open
+		video captures, locks or prefetch threads, each worker unpickles
+		its own copy of the dataset. stage must be picklable (e.g. a module
+		level function)
+	"""
+	if (workers is None):
+		workers = os.cpu_count() or 1
+
+	start = dataset.currentFrameIndex
+	end = dataset.endFrame
+	numFrames = max(0, end - start)
+
+	if (chunkSize is None):
+		# Several chunks per worker to balance uneven per-frame cost
+		chunkSize = max(1, -(-numFrames // (4 * workers)))
+
+	chunks = [(i, min(i + chunkSize, end)) for i in range(start, end, chunkSize)]
+
+	context = multiprocessing.get_context('spawn')
+
+	with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+		initializer=_initWorker, initargs=(dataset,)) as executor:
+
+		# Bound number of chunks in flight so results don't pile up in memory
+		pending = collections.deque()
+		results = collections.deque()
+		chunkIter = iter(chunks)
+
+		try:
+			for chunk in chunkIter:
+				pending.append(executor.submit(_processChunk, stage, chunk, shareThreshold))
+
+				if (len(pending) >= 2 * workers):
+					break
+
+			while (len(pending) > 0):
+				results.extend(pending.popleft().result())
+
+				chunk = next(chunkIter, None)
+				if (chunk is not None):
+					pending.append(executor.submit(_processChunk, stage, chunk, shareThreshold))
+
+				while (len(results) > 0):
+					timestamp, result = results.popleft()
+					yield (_unshare(result), timestamp)
+		finally:
+			# Stopped early or a chunk failed, free results never handed out
+			for future in pending:
+				future.cancel()
+
+			for future in pending:
+				if (not future.cancelled() and future.exception() is None):
+					results.extend(future.result())
+
+			for timestamp, result in results:
+				_discard(result)
+
+
+def _initWorker(dataset):
+	global _workerDataset
+	_workerDataset = dataset
+
+
+def _processChunk(stage, chunk, shareThreshold):
+	start, end = chunk
+	results = []
+
+	try:
+		for index in range(start, end):
+			timestamp = _workerDataset.frameTime(index)
+			result = stage(_workerDataset._loadFrame(index), timestamp)
+			results.append((timestamp, _share(result, shareThreshold)))
+	except BaseException:
+		# Blocks of earlier frames are never returned, unlink them here
+		for timestamp, result in results:
+			_discard(result)
+		raise
+
+	return results
+
+
+def _share(result, threshold):
+	if (isinstance(result, np.ndarray)):
+		if (result.nbytes < threshold or result.dtype.hasobject):
+			return result
+
+		shm = shared_memory.SharedMemory(create=True, size=result.nbytes)
+		np.ndarray(result.shape, dtype=result.dtype, buffer=shm.buf)[...] = result
+
+		# Parent process takes ownership of the block and unlinks it
+		resource_tracker.unregister(shm._name, 'shared_memory')
+		shm.close()
+
+		return SharedArray(shm.name, result.shape, result.dtype.str)
+
+	if (isinstance(result, (tuple, list))):
+		return type(result)(_share(r, threshold) for r in result)
+
+	if (isinstance(result, dict)):
+		return {k:_share(v, threshold) for k, v in result.items()}
+
+	return result
+
+
+def _unshare(result):
+	if (isinstance(result, SharedArray)):
+		shm = shared_memory.SharedMemory(name=result.name)
+		arr = np.ndarray(result.shape, dtype=np.dtype(result.dtype), buffer=shm.buf)
+
+		# Release shared block once the array and all its views are gone
+		weakref.finalize(arr, _release, shm)
+
+		return arr
+
+	if (isinstance(result, (tuple, list))):
+		return type(result)(_unshare(r) for r in result)
+
+	if (isinstance(result, dict)):
+		return {k:_unshare(v) for k, v in result.items()}
+
+	return result
+
+
+def _discard(result):
+	# Unlinks the shared blocks of a result that is never unshared
+	if (isinstance(result, SharedArray)):
+		_release(shared_memory.SharedMemory(name=result.name))
+
+	elif (isinstance(result, (tuple, list))):
+		for r in result:
+			_discard(r)
+
+	elif (isinstance(result, dict)):
+		for r in result.values():
+			_discard(r)
+
+
+def _release(shm):
+	shm.close()
+	shm.unlink()
@@ -0,0 +1,129 @@
+import time
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+class FramePrefetcher(object):
+	""" Decodes upcoming frames ahead of the reader on a bounded thread pool
+
+		self._loader: Callable returning the decoded frame for an index
+		self._indices: Iterator over frame indices not yet queued for decode
+		self._buffer: Ring buffer of (index, future) pairs, at most depth long
+		self._depth: Maximum number of frames decoded ahead of the reader
+
+	"""
+
+	def __init__(self, loader, indices, depth=4, workers=2):
+		self._loader = loader
+		self._depth = max(1, depth)
+		self._workers = max(1, workers)
+
+		self._executor = ThreadPoolExecutor(max_workers=self._workers)
+		self._buffer = collections.deque()
+		self._indices = iter(())
+
+		# Decode statistics, updated from worker threads
+		self._lock = threading.Lock()
+		self._decodeTime = 0.
+		self._decodeCount = 0
+		self._lastDecodeTime = 0.
+
+		# Number of reads which had to wait on an unfinished decode
+		self._stalls = 0
+
+		self.reset(indices)
+
+	def _decode(self, index):
+		start = time.perf_counter()
+		frame = self._loader(index)
+		elapsed = time.perf_counter() - start
+
+		with self._lock:
+			self._decodeTime += elapsed
+			self._decodeCount += 1
+			self._lastDecodeTime = elapsed
+
+		return frame
+
+	def _fill(self):
+		while (len(self._buffer) < self._depth):
+			index = next(self._indices, None)
+
+			if (index is None):
+				break
+
+			self._buffer.append((index, self._executor.submit(self._decode, index)))
+
+	def reset(self, indices):
+		""" Drops all buffered frames and starts decoding from indices
+
+		"""
+		for _, future in self._buffer:
+			future.cancel()
+
+		self._buffer.clear()
+		self._indices = iter(indices)
+		self._fill()
+
+	def next(self):
+		""" Returns (index, frame) of the next frame in the sequence
+
+			Blocks until the frame has been decoded, returns (None, None)
+			once all indices have been consumed
+		"""
+		if (len(self._buffer) < 1):
+			return (None, None)
+
+		index, future = self._buffer.popleft()
+
+		if (not future.done()):
+			self._stalls += 1
+
+		frame = future.result()
+
+		# Top up ring buffer with the next index
+		self._fill()
+
+		return (index, frame)
+
+	def close(self):
+		for _, future in self._buffer:
+			future.cancel()
+
+		self._buffer.clear()
+		self._executor.shutdown(wait=True)
+
+	@property
+	def depth(self):
+		return self._depth
+
+	@property
+	def workers(self):
+		return self._workers
+
+	@property
+	def queueDepth(self):
+		# Number of frames already decoded and waiting to be read
+		return sum(1 for _, future in self._buffer if future.done())
+
+	@property
+	def pending(self):
+		return len(self._buffer)
+
+	@property
+	def decodeLatency(self):
+		# Mean time in seconds spent decoding a single frame
+		with self._lock:
+			if (self._decodeCount < 1):
+				return 0.
+
+			return self._decodeTime / self._decodeCount
+
+	@property
+	def lastDecodeLatency(self):
+		return self._lastDecodeTime
+
+	@property
+	def stalls(self):
+		return self._stalls
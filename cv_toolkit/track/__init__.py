@@ -1 +1 @@
-__all__ = ['flow', 'features']
\ No newline at end of file
+__all__ = ['flow', 'features', 'matching', 'store']
\ No newline at end of file
@@ -1,7 +1,7 @@
 import numpy as np
 import cv2
 
-from primitives.keypoint import KeyPoint
+from .matching import BruteForceMatcher
 
 
 class KeyPointWrapper(object):
@@ -10,39 +10,115 @@ class KeyPointWrapper(object):
 		self.pt = tuple(point)
 
 class SparseFeatureTracker(object):
+	""" Tracks keypoints between frames by matching descriptors
 
-	def __init__(self, detector):
+		Keypoints carry ids, matched keypoints keep the id of the keypoint
+		they continue. The descriptors of the last frame's keypoints are
+		kept by id so they are not computed again for the next match.
+
+		self._matcher: Matcher from track.matching, brute force by default
+		self._storeIds: Sorted ids of the stored descriptors
+		self._storeDescriptors: Descriptors in the order of self._storeIds
+	"""
+
+	def __init__(self, detector, matcher=None):
 		self._detector = detector
-		self._matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+		self._matcher = BruteForceMatcher(cv2.NORM_HAMMING, crossCheck=True) if matcher is None else matcher
 
 		self._prevImg = None
 
+		self._nextId = 0
+		self._storeIds = np.empty(0, dtype=np.int64)
+		self._storeDescriptors = None
+
 	def initialize(self, img, mask):
-		self._kp, self._descriptors = self._detector.detectKeyPoints(img, mask)
+		self._kp, descriptors = self._detector.detectKeyPoints(img, mask)
 		self._prevImg = img
 
+		self._assignIds(self._kp)
+		self._store(self._kp, descriptors)
+
 		return self._kp
 
-	def trackPoints(self, points, img, mask=None):
+	def trackPoints(self, points, img, mask=None, displacement=None):
 		if (self._prevImg is None):
 			self._prevImg = img
 			return
 
-		self._kp = [cv2.KeyPoint(**(kp.getCVKeyPointParams())) for kp in points if kp is not None]
-		self._descriptors = self._detector.compute(self._prevImg, self._kp)
+		# Only points without a stored descriptor are computed on the previous frame
+		queryIndex, queryDescriptors = self._descriptors(self._prevImg, points)
 	
 		keyPoints, descriptors = self._detector.detectKeyPoints(img, mask)
 
-		matches = self._matcher.match(self._descriptors, descriptors)
-		print(len(keyPoints), len(self._kp), len(matches))
-		matchedKP = [keyPoints[m.trainIdx] for m in matches]
-		indices = [m.queryIdx for m in matches]
+		# Displacement predicts where points moved for spatially gated matchers
+		if (displacement is not None and np.ndim(displacement) > 1):
+			displacement = np.asarray(displacement)[queryIndex]
+
+		queryIdx, trainIndex, _ = self._matcher.match(points.points[queryIndex], queryDescriptors,
+													keyPoints.points, descriptors, displacement)
+
+		print(len(keyPoints), len(points), len(queryIdx))
+		indices = queryIndex[queryIdx]
+
+		# Matched keypoints continue the identity of the point they matched
+		self._assignIds(keyPoints)
+		continued = points.ids[indices] >= 0
+		keyPoints.ids[trainIndex[continued]] = points.ids[indices[continued]]
+
+		matchedKP = keyPoints[trainIndex]
 
 		#print(matchedKP)
 		self._prevImg = img
 
 		self._kp = keyPoints
-		self._descriptors = descriptors
+		self._store(keyPoints, descriptors)
 
 		return (matchedKP, indices)
 
+	def _assignIds(self, keyPoints):
+		keyPoints.ids = np.arange(self._nextId, self._nextId + len(keyPoints), dtype=np.int64)
+		self._nextId += len(keyPoints)
+
+	def _store(self, keyPoints, descriptors):
+		# Replaces the store with the descriptors of the latest keypoints
+		order = np.argsort(keyPoints.ids, kind='stable')
+		self._storeIds = keyPoints.ids[order]
+		self._storeDescriptors = np.asarray(descriptors)[order] if len(order) > 0 else None
+
+	def _descriptors(self, img, keyPoints):
+		""" Returns (index, descriptors) of the keyPoints that have a descriptor
+
+			Descriptors come from the store where the keypoint id is found
+			and are computed on img for the others.
+		"""
+		ids = keyPoints.ids
+		found = np.zeros(len(ids), dtype=bool)
+		position = np.zeros(len(ids), dtype=int)
+
+		if (len(self._storeIds) > 0):
+			position = np.minimum(np.searchsorted(self._storeIds, ids), len(self._storeIds) - 1)
+			found = (ids >= 0) & (self._storeIds[position] == ids)
+
+		missing = np.flatnonzero(~found)
+		if (len(missing) < 1):
+			return (np.arange(len(ids)), self._storeDescriptors[position])
+
+		computed = self._detector.compute(img, keyPoints[missing])
+
+		if (computed is None or len(computed) != len(missing)):
+			# Compute drops keypoints it can't describe, rows no longer line up
+			print("Warning: Could not compute descriptors for", len(missing), "keypoints")
+			index = np.flatnonzero(found)
+			if (len(index) < 1):
+				return (index, np.asarray([]))
+
+			return (index, self._storeDescriptors[position[index]])
+
+		if (len(missing) == len(ids)):
+			return (np.arange(len(ids)), computed)
+
+		descriptors = np.empty((len(ids), computed.shape[1]), dtype=computed.dtype)
+		descriptors[found] = self._storeDescriptors[position[found]]
+		descriptors[missing] = computed
+
+		return (np.arange(len(ids)), descriptors)
@@ -1,9 +1,11 @@
 import numpy as np
 import cv2
 
+from ..cams import remapPoints
+
 class LKOpticalFlowTracker(object):
 
-	def __init__(self, winSize=(21,21), maxLevel=5, maxIter=30, epsilon=0.01):
+	def __init__(self, winSize=(21,21), maxLevel=5, maxIter=30, epsilon=0.01, maxError=None):
 		self._winSize = winSize
 		self._maxLevel = maxLevel
 		self._criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, maxIter, epsilon)
@@ -12,51 +14,210 @@ class LKOpticalFlowTracker(object):
 
 		self._deviationThreshold = 1.
 
+		# Largest LK matching error accepted, None accepts any
+		self._maxError = maxError
+
 		self._params = dict(winSize = self._winSize, maxLevel = self._maxLevel,
 							criteria = self._criteria)
 
 	def loadImage(self, img):
 		self._prevImg = img
 
-	def trackPoints(self, points, img):
-		if (self._prevImg is None):
-			self._prevImg = img
-			return [None for _ in points]
+	def track(self, points, img):
+		""" Tracks points from the previous image into img
+
+			Returns (nextPoints, validMask, fbError) as (n, 2) float32, (n,)
+			bool and (n,) float32 arrays. A point is valid when LK found it,
+			its error is within maxError and it tracks back to within the
+			deviation threshold of where it started. fbError is the largest
+			per axis forward-backward deviation, inf for points LK lost.
+		"""
+		points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 2)
 
+		if (self._prevImg is None or len(points) < 1):
+			self._prevImg = img
+			return (points.copy(), np.zeros(len(points), dtype=bool), np.full(len(points), np.inf, dtype=np.float32))
 
 		# Run LK forwards
 		nextPoints, status, error = cv2.calcOpticalFlowPyrLK(self._prevImg, img, 
 			points, None, **self._params)
 
-		del status, error
+		nextPoints = nextPoints.reshape(-1, 2)
+		valid = status.ravel() == 1
 
-		# Run LK in reverse
-		prevPoints, status, error = cv2.calcOpticalFlowPyrLK(img, self._prevImg,
-			nextPoints, None, **self._params)
+		if (self._maxError is not None):
+			valid &= error.ravel() <= self._maxError
 
-		del self._prevImg, status, error
+		# Run LK in reverse only for points tracked forwards, unseeded so the
+		# check doesn't start from the answer it is meant to recover
+		fbError = np.full(len(points), np.inf, dtype=np.float32)
 
-		# Compute deviation between original points and back propagation
-		dev = abs(points - prevPoints).reshape(-1,2)
+		if (valid.any()):
+			backPoints, status, error = cv2.calcOpticalFlowPyrLK(img, self._prevImg,
+				nextPoints[valid], None, **self._params)
 
-		# For each pair of points, take max deviation in either axis
-		maxDev = dev.max(-1)
-
-		del dev
+			# For each pair of points, take max deviation in either axis
+			fbError[valid] = np.abs(points[valid] - backPoints.reshape(-1, 2)).max(-1)
+			fbError[valid] = np.where(status.ravel() == 1, fbError[valid], np.inf)
 
 		# Check against max deviation threshold allowed
-		matchQuality = maxDev < self._deviationThreshold
-
-		trackedPoints = []
+		valid &= fbError < self._deviationThreshold
 
-		for (point, match) in zip(nextPoints.reshape(-1,2), matchQuality):
-			if (match):
-				trackedPoints.append(point)
-			else:
-				trackedPoints.append(None)
-			
-		del matchQuality, points, nextPoints, prevPoints
 		self._prevImg = img
 
-		return np.asarray(trackedPoints)
-		#np.float32(trackedPoints).reshape(-1, 2)
\ No newline at end of file
+		return (nextPoints, valid, fbError)
+
+	def trackPoints(self, points, img):
+		""" Returns an object array of tracked points with None for lost points
+
+			Kept for older callers, track returns plain arrays instead
+		"""
+		nextPoints, valid, _ = self.track(points, img)
+
+		trackedPoints = np.empty(len(nextPoints), dtype=object)
+		for i in np.flatnonzero(valid):
+			trackedPoints[i] = nextPoints[i]
+
+		return trackedPoints
+
+
+class DenseFlowTracker(object):
+	""" Dense optical flow between consecutive frames
+
+		Computes the flow field with DIS ('dis') or Farneback ('farneback')
+		on an optionally cropped and downscaled grayscale copy of each frame.
+		Processed frames and the flow field live in buffers that are reused
+		from frame to frame.
+
+		self._roi: (x, y, w, h) region of the full frame processed, None for all
+		self._scale: Processing resolution relative to the full frame
+		self._flow: Latest flow field in processed pixels, (h, w, 2) float32
+	"""
+
+	def __init__(self, method='dis', scale=1., roi=None, params=None):
+		self._method = method
+		self._scale = scale
+		self._roi = roi
+
+		if (method == 'dis'):
+			params = dict(preset=cv2.DISOPTICAL_FLOW_PRESET_FAST) if params is None else params
+			self._dis = cv2.DISOpticalFlow_create(**params)
+		elif (method == 'farneback'):
+			params = dict(pyr_scale=0.5, levels=3, winsize=15, iterations=3,
+						poly_n=5, poly_sigma=1.2, flags=0) if params is None else params
+		else:
+			raise ValueError(f"Unknown dense flow method {method}, expected 'dis' or 'farneback'")
+
+		self._params = params
+
+		self._imgSize = None
+
+		# Two processed frame buffers swapped every frame and the flow buffer
+		self._prevImg = None
+		self._nextImg = None
+		self._gray = None
+		self._flow = None
+
+	def loadImage(self, img):
+		self._imgSize = (img.shape[1], img.shape[0])
+		self._prevImg = self._process(img, self._prevImg)
+
+	def track(self, img):
+		""" Returns the flow field from the previous frame to img
+
+			Displacements are in processed pixels, divide by scale for full
+			frame pixels. None on the first frame. The returned array is
+			overwritten by the next call.
+		"""
+		if (self._prevImg is None):
+			self.loadImage(img)
+			return None
+
+		self._nextImg = self._process(img, self._nextImg)
+
+		if (self._method == 'dis'):
+			self._flow = self._dis.calc(self._prevImg, self._nextImg, self._flow)
+		else:
+			self._flow = cv2.calcOpticalFlowFarneback(self._prevImg, self._nextImg, self._flow, **self._params)
+
+		self._prevImg, self._nextImg = self._nextImg, self._prevImg
+
+		return self._flow
+
+	def _process(self, img, dst):
+		# Grayscale, crop and scale img into dst, reallocated only if the size changed
+		if (img.ndim == 3):
+			self._gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self._gray)
+			img = self._gray
+
+		if (self._roi is not None):
+			x, y, w, h = self._roi
+			img = img[y:y+h, x:x+w]
+
+		if (self._scale == 1.):
+			if (dst is None or dst.shape != img.shape):
+				return img.copy()
+
+			np.copyto(dst, img)
+			return dst
+
+		size = (int(round(img.shape[1] * self._scale)), int(round(img.shape[0] * self._scale)))
+		if (dst is not None and (dst.shape[1], dst.shape[0]) != size):
+			dst = None
+
+		return cv2.resize(img, size, dst=dst, interpolation=cv2.INTER_AREA)
+
+	def sample(self, points):
+		""" Returns the flow at full frame points in full frame pixels, (n, 2)
+
+			Bilinear interpolation of the field, NaN for points outside the
+			processed region or before any flow was computed
+		"""
+		points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+		flow = np.full(points.shape, np.nan, dtype=np.float32)
+
+		if (self._flow is None):
+			return flow
+
+		# Full frame to processed pixel coordinates
+		origin = np.zeros(2, dtype=np.float32) if self._roi is None else np.asarray(self._roi[:2], dtype=np.float32)
+		coords = (points - origin) * self._scale
+
+		h, w = self._flow.shape[:2]
+		inside = (coords[:,0] >= 0) & (coords[:,0] <= w - 1) & (coords[:,1] >= 0) & (coords[:,1] <= h - 1)
+
+		if (inside.any()):
+			flow[inside] = remapPoints(self._flow, coords[inside]) / self._scale
+
+		return flow
+
+	def sampleGrid(self, grid):
+		""" Samples the flow at the cell centers of a primitives Grid over the frame
+
+			Cells are laid out as in GridDetector, grid.dim is (columns, rows).
+			Returns (centers, flow), each (rows, columns, 2) in full frame pixels,
+			None before the first frame as the frame size is unknown.
+		"""
+		if (self._imgSize is None):
+			return None
+
+		cols, rows = grid.dim[0], grid.dim[1]
+		width, height = self._imgSize
+
+		x = (np.arange(cols) + 0.5) * width / cols
+		y = (np.arange(rows) + 0.5) * height / rows
+		centers = np.stack(np.meshgrid(x, y), axis=-1).astype(np.float32)
+
+		return (centers, self.sample(centers).reshape(rows, cols, 2))
+
+	@property
+	def flow(self):
+		return self._flow
+
+	@property
+	def scale(self):
+		return self._scale
+
+	@property
+	def roi(self):
+		return self._roi
@@ -0,0 +1,201 @@
+import numpy as np
+import cv2
+
+# Set bits of every byte value, hamming distance of uint8 descriptors
+popCount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+
+# FLANN index id of locality sensitive hashing
+FLANN_INDEX_LSH = 6
+
+
+def _toArrays(matches):
+	# cv2.DMatch list to (queryIdx, trainIdx, distance) arrays
+	queryIdx = np.asarray([m.queryIdx for m in matches], dtype=int)
+	trainIdx = np.asarray([m.trainIdx for m in matches], dtype=int)
+	distance = np.asarray([m.distance for m in matches], dtype=np.float32)
+
+	return (queryIdx, trainIdx, distance)
+
+
+def _empty():
+	return (np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0, dtype=np.float32))
+
+
+def _best(key, other, distance):
+	# Index of the lowest distance pair for each key, ties to the lowest other
+	order = np.lexsort((other, distance, key))
+	first = np.ones(len(order), dtype=bool)
+	first[1:] = key[order][1:] != key[order][:-1]
+
+	return np.sort(order[first])
+
+
+class BruteForceMatcher(object):
+	""" Compares every query descriptor against every train descriptor
+
+		Matchers return (queryIdx, trainIdx, distance) arrays, point
+		locations are ignored here.
+	"""
+
+	def __init__(self, normType=cv2.NORM_HAMMING, crossCheck=True):
+		self._matcher = cv2.BFMatcher(normType, crossCheck=crossCheck)
+
+	def match(self, queryPoints, queryDescriptors, trainPoints, trainDescriptors, displacement=None):
+		if (len(queryDescriptors) < 1 or len(trainDescriptors) < 1):
+			return _empty()
+
+		return _toArrays(self._matcher.match(queryDescriptors, trainDescriptors))
+
+
+class GridMatcher(object):
+	""" Hamming matcher comparing only keypoints within a search radius
+
+		Train keypoints are hashed into a uniform grid of radius sized cells,
+		each query is compared with the train keypoints of the 3x3 cells
+		around its predicted location. Matches are mutual best matches when
+		crossCheck is set, like cv2.BFMatcher.
+
+		self._radius: Largest distance between predicted and train location
+		self._maxDistance: Largest hamming distance accepted, None for any
+		self._chunkSize: Candidate pairs compared at once, bounds memory
+	"""
+
+	def __init__(self, radius=30., maxDistance=None, crossCheck=True, chunkSize=1<<20):
+		self._radius = radius
+		self._maxDistance = maxDistance
+		self._crossCheck = crossCheck
+		self._chunkSize = chunkSize
+
+	def match(self, queryPoints, queryDescriptors, trainPoints, trainDescriptors, displacement=None):
+		""" Matches uint8 binary descriptors, returns (queryIdx, trainIdx, distance)
+
+			displacement: Predicted motion of the query points, (2,) or (n, 2)
+		"""
+		if (len(queryDescriptors) < 1 or len(trainDescriptors) < 1):
+			return _empty()
+
+		queryPoints = np.asarray(queryPoints, dtype=np.float32).reshape(-1, 2)
+		trainPoints = np.asarray(trainPoints, dtype=np.float32).reshape(-1, 2)
+
+		if (displacement is not None):
+			queryPoints = queryPoints + np.asarray(displacement, dtype=np.float32)
+
+		queryIdx, trainIdx = self._candidates(queryPoints, trainPoints)
+		if (len(queryIdx) < 1):
+			return _empty()
+
+		distance = np.empty(len(queryIdx), dtype=np.uint16)
+		for start in range(0, len(queryIdx), self._chunkSize):
+			chunk = slice(start, start + self._chunkSize)
+			diff = np.bitwise_xor(queryDescriptors[queryIdx[chunk]], trainDescriptors[trainIdx[chunk]])
+			distance[chunk] = popCount[diff].sum(axis=1)
+
+		if (self._maxDistance is not None):
+			keep = distance <= self._maxDistance
+			queryIdx, trainIdx, distance = queryIdx[keep], trainIdx[keep], distance[keep]
+
+		# Best candidate of each query, lowest train index on ties like cv2
+		best = _best(queryIdx, trainIdx, distance)
+
+		if (self._crossCheck):
+			mutual = _best(trainIdx, queryIdx, distance)
+			best = np.intersect1d(best, mutual, assume_unique=True)
+
+		return (queryIdx[best], trainIdx[best], distance[best].astype(np.float32))
+
+	def _candidates(self, queryPoints, trainPoints):
+		""" Returns (queryIdx, trainIdx) of all pairs within the radius
+
+		"""
+		origin = np.minimum(queryPoints.min(axis=0), trainPoints.min(axis=0))
+		trainCell = np.floor((trainPoints - origin) / self._radius).astype(np.int64)
+		queryCell = np.floor((queryPoints - origin) / self._radius).astype(np.int64)
+
+		# Row major cell keys with a border column so neighbours don't wrap
+		width = max(trainCell[:,0].max(), queryCell[:,0].max()) + 3
+		trainKey = (trainCell[:,1] + 1) * width + trainCell[:,0] + 1
+		queryKey = (queryCell[:,1] + 1) * width + queryCell[:,0] + 1
+
+		order = np.argsort(trainKey, kind='stable')
+		sortedKey = trainKey[order]
+
+		queryIdx, trainIdx = [], []
+		for dy in (-1, 0, 1):
+			for dx in (-1, 0, 1):
+				key = queryKey + dy * width + dx
+				start = np.searchsorted(sortedKey, key, 'left')
+				counts = np.searchsorted(sortedKey, key, 'right') - start
+
+				# Expand each query into its run of train keypoints in the cell
+				query = np.repeat(np.arange(len(queryKey)), counts)
+				offset = np.arange(len(query)) - np.repeat(np.cumsum(counts) - counts, counts)
+				queryIdx.append(query)
+				trainIdx.append(order[start[query] + offset])
+
+		queryIdx = np.concatenate(queryIdx)
+		trainIdx = np.concatenate(trainIdx)
+
+		dist = ((queryPoints[queryIdx] - trainPoints[trainIdx])**2).sum(axis=1)
+		within = dist <= self._radius**2
+
+		return (queryIdx[within], trainIdx[within])
+
+	@property
+	def radius(self):
+		return self._radius
+
+	@radius.setter
+	def radius(self, radius):
+		self._radius = radius
+
+
+class LSHMatcher(object):
+	""" Approximate nearest neighbour matcher on a FLANN LSH index
+
+		Scales to large descriptor sets. Each train keypoint keeps only its
+		closest query, but matches are not cross checked. When a predicted
+		displacement is given, matches further than radius from the
+		predicted location are dropped, radius None keeps them.
+	"""
+
+	def __init__(self, tableNumber=6, keySize=12, multiProbeLevel=1, checks=32, radius=30., maxDistance=None):
+		indexParams = dict(algorithm=FLANN_INDEX_LSH, table_number=tableNumber,
+							key_size=keySize, multi_probe_level=multiProbeLevel)
+
+		self._matcher = cv2.FlannBasedMatcher(indexParams, dict(checks=checks))
+		self._radius = radius
+		self._maxDistance = maxDistance
+
+	def match(self, queryPoints, queryDescriptors, trainPoints, trainDescriptors, displacement=None):
+		if (len(queryDescriptors) < 1 or len(trainDescriptors) < 1):
+			return _empty()
+
+		# Queries the LSH buckets miss get no neighbour
+		knn = self._matcher.knnMatch(queryDescriptors, trainDescriptors, k=1)
+		queryIdx, trainIdx, distance = _toArrays([m[0] for m in knn if len(m) > 0])
+
+		keep = np.ones(len(queryIdx), dtype=bool)
+
+		if (self._maxDistance is not None):
+			keep &= distance <= self._maxDistance
+
+		if (self._radius is not None and displacement is not None):
+			predicted = np.asarray(queryPoints, dtype=np.float32).reshape(-1, 2) + np.asarray(displacement, dtype=np.float32)
+
+			offset = np.asarray(trainPoints, dtype=np.float32).reshape(-1, 2)[trainIdx] - predicted[queryIdx]
+			keep &= (offset**2).sum(axis=1) <= self._radius**2
+
+		queryIdx, trainIdx, distance = queryIdx[keep], trainIdx[keep], distance[keep]
+
+		# Several queries may land on one train keypoint, keep the closest
+		best = _best(trainIdx, queryIdx, distance)
+
+		return (queryIdx[best], trainIdx[best], distance[best])
+
+	@property
+	def radius(self):
+		return self._radius
+
+	@radius.setter
+	def radius(self, radius):
+		self._radius = radius
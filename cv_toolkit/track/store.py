@@ -0,0 +1,310 @@
+import numpy as np
+
+# Observation record of the track files written by TrackFileSink
+trackRecordDtype = np.dtype([('id', np.int64), ('time', np.float64), ('x', np.float32), ('y', np.float32)])
+
+class TrackStore(object):
+	""" Columnar storage of tracks for the trackers
+
+		Each track occupies a slot of preallocated arrays holding its id,
+		latest observations and length, slots of retired tracks are reused.
+		Arrays double in size when slots run out, so adding, extending and
+		retiring tracks are single vectorized operations.
+
+		The latest observations of a slot fill a block of history entries.
+		A full block is copied to a chunk of the shared chunk log, linked to
+		the track's previous chunk, and the block refills from its start.
+		Memory follows the observations held rather than the number of
+		slots times the longest track, chunks of retired tracks are reused.
+
+		With historyLimit set the block is a ring buffer keeping only the
+		latest observations and nothing is logged. Retired tracks are handed
+		to sink, any callable taking (ids, positions, times, lengths) with
+		positions and times in chronological order and padded to the same
+		length.
+
+		self._ids: (capacity,) int64 track id of each slot
+		self._positions: (capacity, history, 2) float32 latest observed positions
+		self._times: (capacity, history) float64 latest observation timestamps
+		self._lengths: (capacity,) number of observations of each slot
+		self._active: (capacity,) bool bitmap of slots holding a live track
+		self._lastChunk: (capacity,) latest logged chunk of each slot, -1 if none
+		self._chunkPositions: (chunks, history, 2) float32 logged positions
+		self._chunkTimes: (chunks, history) float64 logged timestamps
+		self._chunkPrev: (chunks,) previous chunk of the same track, -1 if none
+		self._freeChunks: Stack of unused chunks, the first numFree are valid
+	"""
+
+	def __init__(self, capacity=1024, history=16, historyLimit=None, sink=None):
+		if (historyLimit is not None):
+			history = historyLimit
+
+		self._historyLimit = historyLimit
+		self._sink = sink
+
+		self._ids = np.full(capacity, -1, dtype=np.int64)
+		self._positions = np.zeros((capacity, history, 2), dtype=np.float32)
+		self._times = np.zeros((capacity, history), dtype=np.float64)
+		self._lengths = np.zeros(capacity, dtype=np.int64)
+		self._active = np.zeros(capacity, dtype=bool)
+		self._lastChunk = np.full(capacity, -1, dtype=np.int64)
+
+		self._chunkPositions = np.zeros((0, history, 2), dtype=np.float32)
+		self._chunkTimes = np.zeros((0, history), dtype=np.float64)
+		self._chunkPrev = np.zeros(0, dtype=np.int64)
+		self._freeChunks = np.zeros(0, dtype=np.int64)
+		self._numFree = 0
+
+		self._nextId = 0
+		self._numRetired = 0
+
+	def add(self, points, timestamp):
+		""" Starts a track at each point, returns their slots
+
+		"""
+		points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+
+		free = np.flatnonzero(~self._active)
+		if (len(free) < len(points)):
+			self._grow(max(2 * self.capacity, self.numActive + len(points)))
+			free = np.flatnonzero(~self._active)
+
+		slots = free[:len(points)]
+
+		self._ids[slots] = np.arange(self._nextId, self._nextId + len(slots))
+		self._nextId += len(slots)
+
+		self._positions[slots, 0] = points
+		self._times[slots, 0] = timestamp
+		self._lengths[slots] = 1
+		self._active[slots] = True
+		self._lastChunk[slots] = -1
+
+		return slots
+
+	def append(self, slots, points, timestamp):
+		""" Adds an observation at timestamp to the tracks in slots
+
+		"""
+		slots = np.asarray(slots, dtype=np.int64)
+		if (len(slots) < 1):
+			return
+
+		# Wraps around once a block is full
+		index = self._lengths[slots] % self.history
+		self._positions[slots, index] = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+		self._times[slots, index] = timestamp
+		self._lengths[slots] += 1
+
+		if (self._historyLimit is None):
+			full = slots[self._lengths[slots] % self.history == 0]
+
+			if (len(full) > 0):
+				self._logBlocks(full)
+
+	def retire(self, slots):
+		""" Ends the tracks in slots, their slots are reused by later tracks
+
+		"""
+		slots = np.asarray(slots, dtype=np.int64)
+		if (len(slots) < 1):
+			return
+
+		if (self._sink is not None):
+			positions, times, lengths = self._histories(slots)
+			self._sink(self._ids[slots], positions, times, lengths)
+
+		self._releaseChunks(slots)
+
+		self._active[slots] = False
+		self._numRetired += len(slots)
+
+	def retireAll(self):
+		self.retire(self.activeSlots)
+
+	def endpoints(self, slots=None):
+		""" Returns the last observed position of the tracks in slots, (n, 2)
+
+			Defaults to all active slots in slot order
+		"""
+		if (slots is None):
+			slots = self.activeSlots
+
+		return self._positions[slots, (self._lengths[slots] - 1) % self.history]
+
+	def observations(self, slot):
+		""" Returns (positions, times) observed by the track in slot
+
+		"""
+		positions, times, lengths = self._histories([slot])
+
+		return (positions[0, :lengths[0]], times[0, :lengths[0]])
+
+	def _histories(self, slots):
+		""" Returns chronological (positions, times, lengths) of the tracks in slots
+
+			Rows are padded to the longest track, lengths counts the
+			observations still held
+		"""
+		slots = np.asarray(slots, dtype=np.int64)
+		history = self.history
+
+		if (self._historyLimit is not None):
+			lengths = np.minimum(self._lengths[slots], history)
+
+			# Oldest observation held is at total length modulo history
+			index = (self._lengths[slots] - lengths)[:, np.newaxis] + np.arange(history)
+			index %= history
+
+			return (self._positions[slots[:, np.newaxis], index], self._times[slots[:, np.newaxis], index], lengths)
+
+		lengths = self._lengths[slots]
+		positions = np.zeros((len(slots), lengths.max(initial=0), 2), dtype=np.float32)
+		times = np.zeros((len(slots), lengths.max(initial=0)), dtype=np.float64)
+
+		# Logged chunks, walked back from the latest one of each track
+		rows = np.arange(len(slots))
+		chunks = self._lastChunk[slots]
+		blocks = lengths // history - 1
+
+		while (len(rows) > 0):
+			linked = chunks >= 0
+			rows, chunks, blocks = rows[linked], chunks[linked], blocks[linked]
+
+			columns = blocks[:, np.newaxis] * history + np.arange(history)
+			positions[rows[:, np.newaxis], columns] = self._chunkPositions[chunks]
+			times[rows[:, np.newaxis], columns] = self._chunkTimes[chunks]
+
+			chunks = self._chunkPrev[chunks]
+			blocks = blocks - 1
+
+		# Observations since the last full block
+		logged = (lengths // history) * history
+		rows, index = np.nonzero(np.arange(history) < (lengths - logged)[:, np.newaxis])
+		positions[rows, logged[rows] + index] = self._positions[slots[rows], index]
+		times[rows, logged[rows] + index] = self._times[slots[rows], index]
+
+		return (positions, times, lengths)
+
+	def _logBlocks(self, slots):
+		# Copies the full blocks of slots to new chunks of the log
+		if (self._numFree < len(slots)):
+			self._growChunks(max(2 * len(self._chunkPrev), len(self._chunkPrev) + len(slots), 64))
+
+		chunks = self._freeChunks[self._numFree - len(slots):self._numFree]
+		self._numFree -= len(slots)
+
+		self._chunkPositions[chunks] = self._positions[slots]
+		self._chunkTimes[chunks] = self._times[slots]
+		self._chunkPrev[chunks] = self._lastChunk[slots]
+		self._lastChunk[slots] = chunks
+
+	def _releaseChunks(self, slots):
+		# Returns every chunk logged by the tracks in slots to the free stack
+		chunks = self._lastChunk[slots]
+		self._lastChunk[slots] = -1
+
+		while (len(chunks) > 0):
+			chunks = chunks[chunks >= 0]
+
+			self._freeChunks[self._numFree:self._numFree + len(chunks)] = chunks
+			self._numFree += len(chunks)
+
+			chunks = self._chunkPrev[chunks]
+
+	def _grow(self, capacity):
+		extra = capacity - self.capacity
+
+		self._ids = np.concatenate((self._ids, np.full(extra, -1, dtype=np.int64)))
+		self._positions = np.concatenate((self._positions, np.zeros((extra,) + self._positions.shape[1:], dtype=np.float32)))
+		self._times = np.concatenate((self._times, np.zeros((extra,) + self._times.shape[1:], dtype=np.float64)))
+		self._lengths = np.concatenate((self._lengths, np.zeros(extra, dtype=np.int64)))
+		self._active = np.concatenate((self._active, np.zeros(extra, dtype=bool)))
+		self._lastChunk = np.concatenate((self._lastChunk, np.full(extra, -1, dtype=np.int64)))
+
+	def _growChunks(self, numChunks):
+		current = len(self._chunkPrev)
+		extra = numChunks - current
+
+		self._chunkPositions = np.concatenate((self._chunkPositions, np.zeros((extra, self.history, 2), dtype=np.float32)))
+		self._chunkTimes = np.concatenate((self._chunkTimes, np.zeros((extra, self.history), dtype=np.float64)))
+		self._chunkPrev = np.concatenate((self._chunkPrev, np.full(extra, -1, dtype=np.int64)))
+
+		# New chunks go on the free stack below the ones already free
+		free = np.empty(numChunks, dtype=np.int64)
+		free[:extra] = np.arange(numChunks - 1, current - 1, -1)
+		free[extra:extra + self._numFree] = self._freeChunks[:self._numFree]
+		self._freeChunks = free
+		self._numFree += extra
+
+	@property
+	def activeSlots(self):
+		return np.flatnonzero(self._active)
+
+	@property
+	def numActive(self):
+		return int(np.count_nonzero(self._active))
+
+	@property
+	def capacity(self):
+		return len(self._ids)
+
+	@property
+	def history(self):
+		return self._positions.shape[1]
+
+	@property
+	def numChunks(self):
+		return len(self._chunkPrev) - self._numFree
+
+	@property
+	def ids(self):
+		return self._ids
+
+	@property
+	def numCreated(self):
+		return self._nextId
+
+	@property
+	def numRetired(self):
+		return self._numRetired
+
+	@property
+	def sink(self):
+		return self._sink
+
+
+class TrackFileSink(object):
+	""" Appends retired tracks to a binary file of trackRecordDtype observations
+
+		Read back with readTrackFile
+	"""
+
+	def __init__(self, filename):
+		self._filename = filename
+		self._file = open(filename, 'ab')
+
+	def __call__(self, ids, positions, times, lengths):
+		held = np.arange(times.shape[1]) < lengths[:, np.newaxis]
+
+		records = np.empty(int(lengths.sum()), dtype=trackRecordDtype)
+		records['id'] = np.repeat(ids, lengths)
+		records['time'] = times[held]
+		records['x'] = positions[held][:, 0]
+		records['y'] = positions[held][:, 1]
+
+		self._file.write(records.tobytes())
+
+	def close(self):
+		self._file.close()
+
+	@property
+	def filename(self):
+		return self._filename
+
+
+def readTrackFile(filename):
+	""" Returns the observations in a track file, grouped by track in retirement order
+
+	"""
+	return np.fromfile(filename, dtype=trackRecordDtype)
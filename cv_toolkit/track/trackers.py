@@ -3,8 +3,12 @@ from abc import ABCMeta, abstractmethod
 import numpy as np
 import cv2
 
-from ..core import tracking
-from . import detectors
+from primitives.track import Track
+
+from ..detect.features import ShiTomasiDetector
+from ..detect.adapters import GridDetector
+from .store import TrackStore
+
 class Tracker(metaclass=ABCMeta):
 
 	@abstractmethod
@@ -18,14 +22,34 @@ class Tracker(metaclass=ABCMeta):
 
 class LKOpticalFlowTracker(Tracker):
 
-	def __init__(self, lkParams, featureParams, detectionInterval=0.1):
+	def __init__(self, lkParams, featureParams, detectionInterval=0.1, historyLimit=None, sink=None,
+				detector=None, mask=None):
 		self._lkParams = lkParams
 		self._featureParams = featureParams
 
+		# Detector persists between frames, featureParams configure the
+		# default one with maxCorners per grid cell
+		if (detector is None):
+			gridDim = (15, 20)
+			featureParams = dict(featureParams)
+			cellLimit = featureParams.pop('maxCorners', 100)
+			detector = GridDetector(ShiTomasiDetector(cellLimit, **featureParams), gridDim,
+									cellLimit * gridDim[0] * gridDim[1], borderBuffer=35)
+
+		self._detector = detector
+
+		# Static search mask, e.g. Dataset.mask, the shadow mask is built on first use otherwise
+		self._mask = mask
+
+		# New features are kept this far from existing track endpoints
+		self._exclusionRadius = 5
+
 		self._prevImg = None
 		self._prevTimestamp = None
 
-		self._activeTracks = []
+		# Active tracks are kept in columnar arrays, lost ones are retired to sink
+		self._tracks = TrackStore(historyLimit=historyLimit, sink=sink)
+		self._counters = dict(created=0, retired=0, active=0)
 		self._detectionInterval = detectionInterval
 		self._prevDetectionTime = None
 
@@ -37,39 +61,25 @@ class LKOpticalFlowTracker(Tracker):
 
 		trackEndpoints = self.getTrackEndpoints()
 
-		newTracks = []
+		numCreated, numRetired = self._tracks.numCreated, self._tracks.numRetired
 
-		gridDetector = detectors.GridFeatureDetector(cv2.goodFeaturesToTrack, (15,20), borderBuffer=35)
+		newPoints = None
 
 		# If features have never been detected or detectionInverval has lapsed
 		if (self._prevDetectionTime is None or timestamp - self._prevDetectionTime > self._detectionInterval):
 			#print("Finding New Features")
 			self._prevDetectionTime = timestamp
-			searchMask = np.zeros_like(grayImg)
-			searchMask[:] = 255
-
-			# Masks right side of image
-			#searchMask[:, -320:] = 0
-
-			# Masks shadow region
-			
-			searchMask[:300, -1200:] = 0
-			searchMask[300:850, -1100:] = 0
-			searchMask[:, -300:] = 0
-			searchMask[850:1100, -800:-400] = 0
-			
 
-			# Mask all the current track end points
-			for (x,y) in trackEndpoints:
-				cv2.circle(searchMask, (x,y), 5, 0, -1)
+			if (self._mask is None):
+				self._mask = self._shadowMask(grayImg.shape)
 
-			p = gridDetector.detect(grayImg, searchMask, self._featureParams)
+			# Top up cells below their budget, away from the current track end points
+			points = self._detector.redetect(grayImg, self._mask, trackEndpoints, 1., self._exclusionRadius)
+			newPoints = points[len(trackEndpoints):]
 
-			if (p is not None):
-				for x, y in np.float32(p).reshape(-1, 2):
-					newTracks.append(tracking.Track((x,y), timestamp))
+		activeSlots = self._tracks.activeSlots
 
-		if (self._prevImg is not None):
+		if (self._prevImg is not None and len(activeSlots) > 0):
 			prevPoints = np.float32(trackEndpoints).reshape(-1,1,2)
 
 			# Run LK forwards
@@ -89,28 +99,54 @@ class LKOpticalFlowTracker(Tracker):
 			# Check against max deviation threshold allowed
 			matchQuality = maxDev < self._deviationThreshold
 
-			for (track, point, match) in zip(self._activeTracks, nextPoints.reshape(-1,2), matchQuality):
-				if (match):
-					track.addObservation(point, timestamp)
-					newTracks.append(track)
+			self._tracks.append(activeSlots[matchQuality], nextPoints.reshape(-1,2)[matchQuality], timestamp)
 
-				# Todo: Handle tracks that have been lost
+			# Lost tracks are complete, hand them to the sink
+			self._tracks.retire(activeSlots[~matchQuality])
 
+		# Tracks started this frame are added after the existing ones moved
+		if (newPoints is not None):
+			self._tracks.add(np.float32(newPoints).reshape(-1, 2), timestamp)
 
-		self._activeTracks = newTracks
+		self._counters = dict(created=self._tracks.numCreated - numCreated,
+							retired=self._tracks.numRetired - numRetired,
+							active=self._tracks.numActive)
 
 		self._prevImg = grayImg
 		self._prevTimestamp = timestamp
 
+	def _shadowMask(self, shape):
+		searchMask = np.full(shape, 255, dtype=np.uint8)
 
-	def getTrackEndpoints(self):
-		endpoints = []
+		# Masks right side of image
+		#searchMask[:, -320:] = 0
+
+		# Masks shadow region
+		searchMask[:300, -1200:] = 0
+		searchMask[300:850, -1100:] = 0
+		searchMask[:, -300:] = 0
+		searchMask[850:1100, -800:-400] = 0
 
-		for track in self._activeTracks:
-			(time, position) = track.getLastObservation()
-			endpoints.append(position)
+		return searchMask
 
-		return endpoints
+	def finish(self):
+		# Retires the remaining tracks, call at the end of a run
+		self._tracks.retireAll()
+
+	def getTrackEndpoints(self):
+		# Last position of every active track, in slot order
+		return self._tracks.endpoints()
 
 	def getTracks(self):
-		return self._activeTracks
\ No newline at end of file
+		tracks = []
+
+		for slot in self._tracks.activeSlots:
+			positions, times = self._tracks.observations(slot)
+			tracks.append(Track(list(positions), list(times), int(self._tracks.ids[slot])))
+
+		return tracks
+
+	@property
+	def counters(self):
+		# Tracks created, retired and active in the last processed frame
+		return self._counters
\ No newline at end of file
@@ -24,18 +24,38 @@ class UndistortionTransform(Transform):
 		return newTrack
 
 	def transformTracks(self, tracks):
-		for track in tracks:
-			points = np.asarray(track.positions)
-			undistorted = self._camera.undistortPoints(points)
-			newTrack = Track(np.asarray(undistorted), track.times, track.id)
+		# Undistort positions of all tracks in a single batched call
+		tracks = list(tracks)
+		undistorted = self._transformPositions(self._camera.undistortPoints, tracks)
+
+		for track, points in zip(tracks, undistorted):
+			newTrack = Track(points, track.times, track.id)
 			yield newTrack
-			
+
 	def inverseTransformTrack(self, track):
 		points = np.asarray(track.positions)
 		distorted = self._camera.distortPoints(points)
 		newTrack = Track(np.asarray(distorted), track.times, track.id)
 		return newTrack
 
+	def inverseTransformTracks(self, tracks):
+		tracks = list(tracks)
+		distorted = self._transformPositions(self._camera.distortPoints, tracks)
+
+		for track, points in zip(tracks, distorted):
+			newTrack = Track(points, track.times, track.id)
+			yield newTrack
+
+	def _transformPositions(self, transform, tracks):
+		positions = [np.asarray(track.positions).reshape(-1, 2) for track in tracks]
+
+		if (len(positions) < 1):
+			return []
+
+		lengths = np.cumsum([len(p) for p in positions])[:-1]
+
+		return np.split(transform(np.concatenate(positions)), lengths)
+
 	def transformImage(self, img):
 		return self._camera.undistortImage(img)
 
@@ -0,0 +1,83 @@
+import threading
+import cv2
+
+# Container extensions treated as video files rather than image folders
+videoExtensions = ('mp4', 'avi', 'mkv', 'mov', 'm4v', 'mjpeg', 'mjpg', 'h264')
+
+class VideoReader(object):
+	""" Random access frame reader on top of cv2.VideoCapture
+
+		Reads at the current decode position are sequential. Short forward
+		skips grab frames without retrieving them, longer jumps let the
+		backend seek to the nearest keyframe and decode forward from there.
+
+		self._capture: Underlying cv2.VideoCapture
+		self._position: Index of the frame the next capture read returns
+		self._seekThreshold: Largest forward skip handled by grabbing frames
+
+	"""
+
+	def __init__(self, filename, seekThreshold=32):
+		self._filename = filename
+		self._seekThreshold = seekThreshold
+
+		self._capture = cv2.VideoCapture(filename)
+
+		if (not self._capture.isOpened()):
+			print("Error: Cannot open video file", filename)
+
+		self._numFrames = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT))
+		self._fps = self._capture.get(cv2.CAP_PROP_FPS)
+		self._frameSize = (int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+							int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+		self._position = 0
+
+		# Capture is shared between the reader and prefetch threads
+		self._lock = threading.Lock()
+
+	def __reduce__(self):
+		# Captures can't be pickled, reopen the file instead
+		return (VideoReader, (self._filename, self._seekThreshold))
+
+	def __len__(self):
+		return self._numFrames
+
+	def read(self, index):
+		with self._lock:
+			skip = index - self._position
+
+			if (0 < skip <= self._seekThreshold):
+				for _ in range(skip):
+					self._capture.grab()
+			elif (skip != 0):
+				self._capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+
+			ok, frame = self._capture.read()
+			self._position = index + 1
+
+		if (not ok):
+			return None
+
+		return frame
+
+	def release(self):
+		with self._lock:
+			self._capture.release()
+
+	@property
+	def filename(self):
+		return self._filename
+
+	@property
+	def fps(self):
+		return self._fps
+
+	@property
+	def frameSize(self):
+		# (width, height)
+		return self._frameSize
+
+
+def isVideoFile(filename):
+	return filename.lower().rsplit('.', 1)[-1] in videoExtensions
@@ -22,9 +22,11 @@ def mainFunc():
 
 	winSize = (15,15)
 	maxLevel = 0
-	criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+	maxIter = 10
+	epsilon = 0.03
 
-	lk = LKOpticalFlowTracker(winSize, maxLevel, criteria, gray)
+	lk = LKOpticalFlowTracker(winSize, maxLevel, maxIter, epsilon)
+	lk.loadImage(gray)
 
 	detector = ShiTomasiDetector()
 
@@ -42,16 +44,16 @@ def mainFunc():
 		gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 		undistortedImg = transformation.transformImage(img)
 
-		newPoints = lk.trackPoints(points, gray)
+		newPoints, valid, _ = lk.track(points, gray)
 
-		points = np.asarray([p for p in newPoints if p is not None])
+		points = newPoints[valid]
 
-		if len(points) > 100:
-			uPoints = transformation.transformPoints(points)
-			for p in uPoints:
-				cv2.circle(undistortedImg, tuple(p), 3, (255, 0, 0), -1)
-		else:
-			points = gd.detect(gray, data.mask)
+		# Only detect again in the cells that have run low on features
+		points = gd.redetect(gray, data.mask, points)
+
+		uPoints = transformation.transformPoints(points)
+		for p in uPoints:
+			cv2.circle(undistortedImg, tuple(p), 3, (255, 0, 0), -1)
 
 		cv2.imshow('img', undistortedImg)
 		if (cv2.waitKey(1) & 0xFF) == 27:
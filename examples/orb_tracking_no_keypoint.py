@@ -44,18 +44,16 @@ def mainFunc():
 
 		newPoints, indices = sfTracker.trackPoints(points, gray, data.mask)
 
-		points = np.asarray([np.squeeze(p.point) for p in newPoints if p is not None])
-
-		if len(points) > 10:
-			uPoints = transformation.transformPoints(points)
+		if len(newPoints) > 10:
+			uPoints = transformation.transformPoints(newPoints.points)
 			for p in uPoints:
 				cv2.circle(undistortedImg, tuple(p), 5, (255, 0, 0), -1)
+
+			points = newPoints
 		else:
 			print("Detecting new points")
 			points = sfTracker.initialize(gray, data.mask)
 
-		points = newPoints
-
 		cv2.imshow('img', undistortedImg)
 		if (cv2.waitKey(1) & 0xFF) == 27:
 			break
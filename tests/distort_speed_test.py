@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+import timeit
+
+from context import cv_toolkit
+
+from cv_toolkit.cams import FisheyeCamera
+
+
+def distort_loop(cam, points):
+	# Per-point implementation FisheyeCamera.distortPoints replaced
+	pInv = np.linalg.inv(cam._newK)
+
+	newPoints = []
+	for p in points:
+		newP = np.matmul(pInv, np.pad(p, (0,1), 'constant', constant_values=1).reshape(3,1))
+		newPoints.append(np.squeeze(newP[0:2].reshape(1,2)))
+
+	points = np.expand_dims(np.asarray(newPoints), 0)
+
+	return np.squeeze(cv2.fisheye.distortPoints(points.astype(np.float32), cam._K, cam._D)).reshape(-1,2)
+
+
+if __name__ == '__main__':
+	K = [[1500., 0., 2000.], [0., 1500., 1500.], [0., 0., 1.]]
+	D = [[0.05], [0.01], [-0.002], [0.0005]]
+	cam = FisheyeCamera(K, D, (4000, 3000))
+
+	for n in [10, 100, 1000, 10000, 100000, 1000000]:
+		points = np.random.rand(n, 2) * [4000, 3000]
+		number = max(1, int(10000 / n))
+
+		batched = min(timeit.repeat("cam.distortPoints(points)", number=number, repeat=3, globals=globals())) / number
+		undistort = min(timeit.repeat("cam.undistortPoints(points)", number=number, repeat=3, globals=globals())) / number
+
+		if (n <= 100000):
+			loop = min(timeit.repeat("distort_loop(cam, points)", number=number, repeat=3, globals=globals())) / number
+		else:
+			loop = float('nan')
+
+		print(f"{n:>8} points: distort loop {loop*1e3:10.3f} ms, distort batched {batched*1e3:10.3f} ms, undistort batched {undistort*1e3:10.3f} ms")
+
+	# Lookup tables against the exact solver, on a lens the default tolerance holds for
+	K = [[2500., 0., 2000.], [0., 2500., 1500.], [0., 0., 1.]]
+	cam = FisheyeCamera(K, D, (4000, 3000))
+	error = cam.enablePointLookup()
+	print(f"lookup step {cam._undistortLookup.step}, max sample error {error:.4f} px")
+
+	for n in [100, 1000, 10000, 100000, 1000000]:
+		points = np.random.rand(n, 2) * [4000, 3000]
+		number = max(1, int(10000 / n))
+
+		undistort = min(timeit.repeat("cam.undistortPoints(points)", number=number, repeat=3, globals=globals())) / number
+		distort = min(timeit.repeat("cam.distortPoints(points)", number=number, repeat=3, globals=globals())) / number
+
+		cam.disablePointLookup()
+		undistortExact = min(timeit.repeat("cam.undistortPoints(points)", number=number, repeat=3, globals=globals())) / number
+		distortExact = min(timeit.repeat("cam.distortPoints(points)", number=number, repeat=3, globals=globals())) / number
+		cam.enablePointLookup()
+
+		print(f"{n:>8} points: undistort exact {undistortExact*1e3:10.3f} ms, lookup {undistort*1e3:10.3f} ms, distort exact {distortExact*1e3:10.3f} ms, lookup {distort*1e3:10.3f} ms")
@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+import os
+import tempfile
+
+from context import cv_toolkit
+
+from cv_toolkit.data import Dataset
+
+
+def write_frames(folder, numFrames=24, size=(240, 320), seed=0):
+	# Random frames as an image folder and as an mjpeg video next to it
+	rng = np.random.RandomState(seed)
+	frames = [(rng.rand(size[0], size[1], 3) * 255).astype(np.uint8) for _ in range(numFrames)]
+
+	os.makedirs(f"{folder}/imgs")
+	writer = cv2.VideoWriter(f"{folder}/frames.avi", cv2.VideoWriter_fourcc(*'MJPG'), 30, (size[1], size[0]))
+
+	for i, frame in enumerate(frames):
+		cv2.imwrite(f"{folder}/imgs/frame{i:04d}.jpg", frame)
+		writer.write(frame)
+
+	writer.release()
+
+
+def stage(frame, timestamp):
+	# Large result goes back through shared memory, the mean is pickled
+	return (cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), float(frame.mean()))
+
+
+def failing_stage(frame, timestamp):
+	if (timestamp > 0.1):
+		raise RuntimeError("stage failed")
+
+	return stage(frame, timestamp)
+
+
+def check_map(folder, imgFolder, numFrames=24):
+	data = Dataset('map_test', 'today', 'here', imgFolder, 0, numFrames)
+	data.filename = f"{folder}/map_test.yaml"
+	data.load()
+
+	serial = [(stage(frame, t), t) for frame, t in data.frames()]
+	mapped = list(data.map(stage, workers=2, chunkSize=5))
+
+	assert len(mapped) == len(serial), f"{imgFolder}: {len(mapped)} of {len(serial)} frames mapped"
+
+	for ((gray, mean), t), ((expGray, expMean), expT) in zip(mapped, serial):
+		assert t == expT
+		assert np.array_equal(gray, expGray) and mean == expMean
+
+	del mapped
+
+	# Closing the generator early must free shared blocks still in flight
+	blocks = shared_blocks()
+	results = data.map(stage, workers=2, chunkSize=5)
+	next(results)
+	results.close()
+
+	assert shared_blocks() <= blocks, f"{imgFolder}: shared memory leaked on early stop"
+
+	# A stage failing partway through a chunk must free the frames it finished
+	try:
+		list(data.map(failing_stage, workers=2, chunkSize=6))
+	except RuntimeError:
+		pass
+	else:
+		assert False, f"{imgFolder}: stage error not raised"
+
+	assert shared_blocks() <= blocks, f"{imgFolder}: shared memory leaked on stage error"
+
+	data.stopPrefetch()
+	print(f"{imgFolder}: {len(serial)} frames mapped in order")
+
+
+def shared_blocks():
+	# Shared memory blocks currently linked, on systems with /dev/shm
+	if (not os.path.isdir('/dev/shm')):
+		return set()
+
+	return set(os.listdir('/dev/shm'))
+
+
+if __name__ == '__main__':
+	with tempfile.TemporaryDirectory() as folder:
+		write_frames(folder)
+
+		check_map(folder, 'imgs')
+
+		# Video datasets prefetch on load, workers must open their own capture
+		check_map(folder, 'frames.avi')
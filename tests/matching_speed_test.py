@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+import time
+
+from context import cv_toolkit
+
+from cv_toolkit.track.matching import BruteForceMatcher, GridMatcher, LSHMatcher
+
+
+def synthetic_features(n, size=(1920, 1080), shift=(3., 1.), noiseBits=8, seed=0):
+	""" Random ORB sized descriptors and their noisy, shifted and shuffled copies
+
+		Returns (queryPoints, queryDescriptors, trainPoints, trainDescriptors, truth)
+		where truth[i] is the train index of query i
+	"""
+	rng = np.random.RandomState(seed)
+	queryPoints = (rng.rand(n, 2) * size).astype(np.float32)
+	queryDescriptors = rng.randint(0, 256, (n, 32)).astype(np.uint8)
+
+	# Flip a few bits of every descriptor
+	bits = np.unpackbits(queryDescriptors, axis=1)
+	flips = rng.randint(0, bits.shape[1], (n, noiseBits))
+	bits[np.arange(n)[:, np.newaxis], flips] ^= 1
+
+	truth = rng.permutation(n)
+	trainPoints = np.empty_like(queryPoints)
+	trainDescriptors = np.empty_like(queryDescriptors)
+	trainPoints[truth] = queryPoints + shift + rng.randn(n, 2).astype(np.float32)
+	trainDescriptors[truth] = np.packbits(bits, axis=1)
+
+	return (queryPoints, queryDescriptors, trainPoints, trainDescriptors, truth)
+
+
+def run(matcher, features, displacement=None):
+	queryPoints, queryDescriptors, trainPoints, trainDescriptors, truth = features
+
+	start = time.perf_counter()
+	queryIdx, trainIdx, _ = matcher.match(queryPoints, queryDescriptors, trainPoints, trainDescriptors, displacement)
+	elapsed = time.perf_counter() - start
+
+	correct = (truth[queryIdx] == trainIdx).mean() if len(queryIdx) > 0 else 0.
+
+	return (len(queryIdx) / elapsed, correct)
+
+
+if __name__ == '__main__':
+	# (name, matcher, predicted displacement, largest n to run)
+	matchers = [("brute force", BruteForceMatcher(), None, 20000),
+				("grid", GridMatcher(radius=10.), None, None),
+				("grid, predicted", GridMatcher(radius=5.), (3., 1.), None),
+				("lsh", LSHMatcher(), None, None),
+				("lsh, predicted", LSHMatcher(radius=5.), (3., 1.), None)]
+
+	for n in [1000, 5000, 20000, 50000, 100000]:
+		features = synthetic_features(n)
+
+		for name, matcher, displacement, limit in matchers:
+			if (limit is not None and n > limit):
+				continue
+
+			rate, correct = run(matcher, features, displacement)
+			print(f"{n:>7} features, {name:>16}: {rate:12.0f} matches/s, {correct:.3f} correct")
@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+import time
+
+from context import cv_toolkit
+
+from cv_toolkit.detect.features import ShiTomasiDetector
+from cv_toolkit.detect.adapters import GridDetector, PriorityGridDetector
+
+
+def synthetic_sequence(numFrames=60, size=(720, 1280), shift=(2, 1), seed=0):
+	""" Textured scene drifting by shift per frame with a flat occluder crossing it
+
+		Yields (frame, occluder rect) where rect is (x, y, w, h)
+	"""
+	rng = np.random.RandomState(seed)
+	scene = cv2.GaussianBlur((rng.rand(size[0] + numFrames * shift[1], size[1] + numFrames * shift[0]) * 255).astype(np.uint8), (0,0), 3)
+	scene = cv2.normalize(scene, None, 0, 255, cv2.NORM_MINMAX)
+
+	for t in range(numFrames):
+		frame = scene[t*shift[1]:(t*shift[1] + size[0]), t*shift[0]:(t*shift[0] + size[1])].copy()
+
+		rect = (int(t * size[1] / numFrames), size[0] // 3, size[1] // 6, size[0] // 3)
+		x, y, w, h = rect
+		frame[y:y+h, x:x+w] = 128
+
+		yield (frame, rect)
+
+
+def free_mask(shape, points, block=8):
+	# Mask out the blocks holding features already tracked
+	coarse = np.full(((shape[0] + block - 1) // block, (shape[1] + block - 1) // block), 255, dtype=np.uint8)
+	p = (points // block).astype(int).reshape(-1, 2)
+	coarse[p[:,1], p[:,0]] = 0
+
+	mask = cv2.resize(coarse, (coarse.shape[1] * block, coarse.shape[0] * block), interpolation=cv2.INTER_NEAREST)
+
+	return mask[:shape[0], :shape[1]]
+
+
+def advance(points, shift, shape, rect):
+	""" Moves points with the scene, returns (surviving, lost)
+
+		Features under the occluder or outside the frame are lost
+	"""
+	points = points - np.asarray(shift, dtype=points.dtype)
+	x, y, w, h = rect
+	lost = ((points[:,0] < 0) | (points[:,0] >= shape[1]) | (points[:,1] < 0) | (points[:,1] >= shape[0])
+			| ((points[:,0] >= x) & (points[:,0] < x + w) & (points[:,1] >= y) & (points[:,1] < y + h)))
+
+	return (points[~lost], points[lost])
+
+
+def run_uniform(target, gridDim, shift=(2, 1)):
+	# Whole frame re-detection once the tracked set runs low, as in examples/lk_tracking.py
+	gd = GridDetector(ShiTomasiDetector(), gridDim, target)
+	points = np.empty((0, 2), dtype=np.float32)
+	tracked, detectTime = 0, 0.
+
+	for frame, rect in synthetic_sequence(shift=shift):
+		points, lost = advance(points, shift, frame.shape, rect)
+
+		if (len(points) < 0.8 * target):
+			start = time.perf_counter()
+			points = gd.detect(frame, None).reshape(-1, 2)
+			detectTime += time.perf_counter() - start
+
+		tracked += len(points)
+
+	return (tracked, detectTime)
+
+
+def run_priority(target, gridDim, shift=(2, 1)):
+	# Top up once a few features were lost, budget follows where they were lost
+	pgd = PriorityGridDetector(ShiTomasiDetector(), gridDim, target, decay=0.5)
+	points = np.empty((0, 2), dtype=np.float32)
+	tracked, detectTime, lostCount = 0, 0., target
+
+	for frame, rect in synthetic_sequence(shift=shift):
+		points, lost = advance(points, shift, frame.shape, rect)
+
+		start = time.perf_counter()
+		pgd.update(frame.shape, lost)
+		lostCount += len(lost)
+
+		if (lostCount > 0.05 * target):
+			pgd.featureLimit = target - len(points)
+			lostCount = 0
+			newPoints = pgd.detect(frame, free_mask(frame.shape, points, 10))
+			if (len(newPoints) > 0):
+				points = np.vstack((points, newPoints.reshape(-1, 2)))
+		detectTime += time.perf_counter() - start
+
+		tracked += len(points)
+
+	return (tracked, detectTime)
+
+
+if __name__ == '__main__':
+	for gridDim in [(15, 20), (20, 30)]:
+		for target in [1000, 3000]:
+			uniformTracked, uniformTime = run_uniform(target, gridDim)
+			priorityTracked, priorityTime = run_priority(target, gridDim)
+
+			print(f"grid {gridDim}, target {target}: "
+				f"uniform {uniformTracked} tracked in {uniformTime*1e3:.1f} ms ({uniformTracked / (uniformTime*1e3):.1f} per ms), "
+				f"priority {priorityTracked} tracked in {priorityTime*1e3:.1f} ms ({priorityTracked / (priorityTime*1e3):.1f} per ms)")
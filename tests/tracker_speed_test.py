@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+import time
+import timeit
+
+from context import cv_toolkit
+
+from cv_toolkit.detect.adapters import excludePoints
+from cv_toolkit.track.trackers import LKOpticalFlowTracker
+
+
+def synthetic_frames(numFrames=40, size=(1080, 1920), shift=(2, 1), seed=0):
+	# Textured scene drifting by shift pixels per frame, as BGR frames
+	rng = np.random.RandomState(seed)
+	scene = cv2.GaussianBlur((rng.rand(size[0] + numFrames * shift[1], size[1] + numFrames * shift[0]) * 255).astype(np.uint8), (0,0), 3)
+	scene = cv2.normalize(scene, None, 0, 255, cv2.NORM_MINMAX)
+
+	return [cv2.cvtColor(scene[t*shift[1]:(t*shift[1] + size[0]), t*shift[0]:(t*shift[0] + size[1])], cv2.COLOR_GRAY2BGR)
+			for t in range(numFrames)]
+
+
+def circle_mask(shape, points, radius):
+	# Per endpoint circles the tracker used to draw every detection
+	mask = np.full(shape, 255, dtype=np.uint8)
+	for x, y in np.round(points).astype(int):
+		cv2.circle(mask, (int(x), int(y)), radius, 0, -1)
+
+	return mask
+
+
+if __name__ == '__main__':
+	frames = synthetic_frames()
+	mask = np.full(frames[0].shape[:2], 255, dtype=np.uint8)
+
+	lkParams = dict(winSize=(15,15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+	for cellLimit in [5, 20, 50, 100]:
+		featureParams = dict(maxCorners=cellLimit, qualityLevel=0.01, minDistance=5, blockSize=5)
+		tracker = LKOpticalFlowTracker(lkParams, featureParams, detectionInterval=0.1, mask=mask)
+
+		frameTimes, active = [], []
+		for i, frame in enumerate(frames):
+			start = time.perf_counter()
+			tracker.processImage(frame, i / 30.)
+			frameTimes.append(time.perf_counter() - start)
+			active.append(tracker.counters['active'])
+
+		# Endpoint exclusion on its own, per circle against one dilation
+		endpoints = tracker.getTrackEndpoints()
+		circles = min(timeit.repeat(lambda: circle_mask(mask.shape, endpoints, 5), number=5, repeat=3)) / 5
+		dilated = min(timeit.repeat(lambda: excludePoints(mask.shape, endpoints, 5, mask), number=5, repeat=3)) / 5
+
+		print(f"{int(np.mean(active[1:])):>6} active tracks: {np.mean(frameTimes[1:])*1e3:7.1f} ms per frame, "
+			f"exclusion mask circles {circles*1e3:6.2f} ms, dilated impulses {dilated*1e3:6.2f} ms")